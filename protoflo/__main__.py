@@ -50,6 +50,15 @@ if __name__ == "__main__":
 
 	parser_run = subparsers.add_parser('run', help='Run a graph non-interactively')
 	parser_run.add_argument('--file', type=str, help='Graph file .fbp|.json', required=True)
+	parser_run.add_argument('--fuse', action='store_true', help='Fuse chains of map components and regions of math components')
+	parser_run.add_argument('--validate', type=str, choices=('strict', 'sampled', 'off'), help='Validation of the packets arriving at inports', default='off')
+	parser_run.add_argument('--record', type=str, metavar='LOG', help='Record the IIPs and chosen edges to a packet log')
+	parser_run.add_argument('--edge', type=str, action='append', default=[], metavar='SRC.PORT->TGT.PORT', help='Edge to record, may be repeated')
+	parser_run.add_argument('--replay', type=str, metavar='LOG', help='Feed a packet log into the graph and report its performance')
+	parser_run.add_argument('--speed', type=str, choices=('original', 'max'), help='Replay speed', default='original')
+
+	parser_codecs = subparsers.add_parser('codecs', help='Benchmark packet codecs')
+	parser_codecs.add_argument('--number', type=int, help='Packets encoded and decoded per measure', default=10000)
 
 	args = parser.parse_args(sys.argv[1:])
 	if args.command == 'register':
@@ -59,14 +68,73 @@ if __name__ == "__main__":
 		from protoflo.server.server import runtime
 		runtime(args.ip, args.port)
 
+	elif args.command == 'codecs':
+		import codec
+
+		print "{:<8s} {:<10s} {:>8s} {:>12s} {:>12s}".format("codec", "sample", "bytes", "encode (us)", "decode (us)")
+		for name, sample, size, encodeTime, decodeTime in codec.benchmark(args.number):
+			print "{:<8s} {:<10s} {:>8d} {:>12.2f} {:>12.2f}".format(name, sample, size, encodeTime, decodeTime)
+
 	elif args.command == 'run':
 		from twisted.internet import reactor
 		import graph, network
 
-		def onRunning (net):
-			@net.on("end")
-			def stop (data):
+		network.Network.fuse = args.fuse
+		network.Network.validationMode = args.validate
+
+		def onError (failure):
+			failure.printTraceback()
+			reactor.stop()
+
+		def endpoint (spec):
+			node, port = spec.strip().rsplit(".", 1)
+			return { "node": node, "port": port, "index": None }
+
+		if args.replay is not None:
+			import record
+
+			def onConnected (net):
+				replay = record.Replay(net, record.load(args.replay), args.speed)
+				return replay.prepare() \
+					.addCallback(lambda _: replay.run()) \
+					.addCallback(onReport)
+
+			def onReport (report):
+				print "Packets:    {:d}".format(report["packets"])
+				print "Duration:   {:.3f}s".format(report["duration"])
+				print "Throughput: {:.1f} packets/s".format(report["throughput"])
+
+				for name in ("p50", "p90", "p99", "max"):
+					latency = report["latency"][name]
+					if latency is not None:
+						print "Latency {:s}: {:.1f}us".format(name, latency * 1e6)
+
 				reactor.stop()
 
-		network.Network.create(graph.loadFile(args.file)).addCallback(onRunning)
+		elif args.record is not None:
+			import record
+
+			def onConnected (net):
+				edges = [map(endpoint, spec.split("->")) for spec in args.edge]
+				recorder = record.Recorder(net, args.record, edges)
+
+				@net.on("end")
+				def stop (data):
+					recorder.close()
+					reactor.stop()
+
+				net.start()
+
+		else:
+			def onConnected (net):
+				@net.on("end")
+				def stop (data):
+					reactor.stop()
+
+				net.start()
+
+		network.Network.create(graph.loadFile(args.file), delayed = True) \
+			.addCallback(lambda net: net.connect()) \
+			.addCallback(onConnected) \
+			.addErrback(onError)
 		reactor.run()
@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from timeit import default_timer
+import cPickle as pickle
+import json
+import numbers
+import struct
+
+# Codecs turn packets into bytes wherever they leave the process: packet
+# logs, the runtime protocol, etc. The codec is chosen by the datatype of
+# the port the packet goes to. A codec refusing a packet raises Error, and
+# the registry falls back to its default codec (pickle), so any picklable
+# packet can be encoded whatever its port claims.
+#
+# Every codec has a one byte id, stored along with the encoded packet so
+# that it can be decoded without knowing the port.
+
+
+class Codec (object):
+	id = None
+	name = None
+
+	def encode (self, data):
+		raise NotImplementedError
+
+	def decode (self, encoded):
+		raise NotImplementedError
+
+
+class PickleCodec (Codec):
+	""" Pickles anything picklable. """
+
+	id = 1
+	name = "pickle"
+
+	def __init__ (self, protocol = pickle.HIGHEST_PROTOCOL):
+		if protocol > pickle.HIGHEST_PROTOCOL:
+			raise Error("Pickle protocol {:d} is not supported".format(protocol))
+
+		self.protocol = protocol
+
+	def encode (self, data):
+		return pickle.dumps(data, self.protocol)
+
+	def decode (self, encoded):
+		return pickle.loads(encoded)
+
+
+class BytesCodec (Codec):
+	""" Passes byte strings and buffers through as they are. """
+
+	id = 2
+	name = "bytes"
+
+	def encode (self, data):
+		if isinstance(data, str):
+			return data
+
+		if isinstance(data, (bytearray, buffer, memoryview)):
+			return bytes(data)
+
+		raise Error("Not a byte string: {:s}".format(type(data).__name__))
+
+	def decode (self, encoded):
+		return encoded
+
+
+class NumberCodec (Codec):
+	""" Booleans, integers and floats in a type tag and eight bytes. """
+
+	id = 3
+	name = "number"
+
+	_bool = struct.Struct("<c?")
+	_int = struct.Struct("<cq")
+	_float = struct.Struct("<cd")
+
+	def encode (self, data):
+		# The common types first, the abstract ones are slow to check
+		kind = type(data)
+
+		if kind is float:
+			return self._float.pack("d", data)
+
+		if kind is int:
+			return self._int.pack("q", data)
+
+		# bool can't be subclassed, so this catches every boolean
+		if kind is bool:
+			return self._bool.pack("?", data)
+
+		if isinstance(data, numbers.Integral):
+			data = int(data)
+
+			if -2 ** 63 <= data < 2 ** 63:
+				return self._int.pack("q", data)
+
+			# Integers beyond 64 bits, in decimal
+			return "L" + str(data)
+
+		if isinstance(data, numbers.Real):
+			return self._float.pack("d", float(data))
+
+		raise Error("Not a number: {:s}".format(type(data).__name__))
+
+	def decode (self, encoded):
+		tag = encoded[:1]
+
+		try:
+			if tag == "q":
+				return self._int.unpack(encoded)[1]
+			if tag == "d":
+				return self._float.unpack(encoded)[1]
+			if tag == "?":
+				return self._bool.unpack(encoded)[1]
+			if tag == "L":
+				return int(encoded[1:])
+		except (struct.error, ValueError):
+			pass
+
+		raise Error("Invalid number encoding")
+
+
+class JSONCodec (Codec):
+	""" JSON, for clients such as the UI. """
+
+	id = 4
+	name = "json"
+
+	def __init__ (self):
+		self._encode = json.JSONEncoder().encode
+		self._decode = json.JSONDecoder().decode
+
+	def encode (self, data):
+		try:
+			return self._encode(data)
+		except (TypeError, ValueError) as e:
+			raise Error("Not representable in JSON: {:s}".format(e))
+
+	def decode (self, encoded):
+		try:
+			return self._decode(encoded)
+		except ValueError as e:
+			raise Error("Invalid JSON: {:s}".format(e))
+
+
+class Registry (object):
+	def __init__ (self, default):
+		self.default = default
+		self.datatypes = {}
+		self.ids = {}
+
+		self.add(default)
+
+	def add (self, codec):
+		if self.ids.get(codec.id, codec) is not codec:
+			raise Error("Codec id {:d} already used by {:s}".format(codec.id, self.ids[codec.id].name))
+
+		self.ids[codec.id] = codec
+
+	def register (self, datatype, codec):
+		""" Use [codec] for the packets of ports of [datatype]. """
+
+		self.add(codec)
+		self.datatypes[datatype] = codec
+
+	def get (self, datatype):
+		return self.datatypes.get(datatype, self.default)
+
+	def encode (self, datatype, data):
+		"""
+		@return: (codec id, encoded packet) tuple.
+		"""
+
+		codec = self.datatypes.get(datatype, self.default)
+
+		if codec is not self.default:
+			try:
+				return codec.id, codec.encode(data)
+			except Error:
+				pass
+
+		return self.default.id, self.default.encode(data)
+
+	def decode (self, id, encoded):
+		try:
+			codec = self.ids[id]
+		except KeyError:
+			raise Error("Unknown codec {:d}".format(id))
+
+		return codec.decode(encoded)
+
+
+registry = Registry(PickleCodec())
+registry.add(JSONCodec())
+registry.register("buffer", BytesCodec())
+
+_number = NumberCodec()
+registry.register("number", _number)
+registry.register("int", _number)
+registry.register("boolean", _number)
+
+# Clients of the runtime protocol only read JSON, so packets sent to them
+# go through a registry of their own, with JSON as the default
+clients = Registry(JSONCodec())
+
+
+def benchmark (number = 10000):
+	"""Time every codec on sample packets it accepts.
+
+	@return: C{list} of (codec, sample, size, encode time, decode time) tuples,
+		the times in microseconds per packet.
+	"""
+
+	samples = OrderedDict((
+		("int", 42),
+		("float", 3.14159),
+		("string", "hello world" * 4),
+		("bytes 64k", "\x00" * 65536),
+		("array", range(100)),
+		("object", { "id": 1, "name": "packet", "tags": ["a", "b"], "value": 2.5 }),
+	))
+
+	codecs = [PickleCodec(), BytesCodec(), NumberCodec(), JSONCodec()]
+	results = []
+
+	for codec in codecs:
+		for name, sample in samples.iteritems():
+			try:
+				encoded = codec.encode(sample)
+			except Error:
+				continue
+
+			start = default_timer()
+			for i in xrange(number):
+				codec.encode(sample)
+			encodeTime = (default_timer() - start) / number
+
+			start = default_timer()
+			for i in xrange(number):
+				codec.decode(encoded)
+			decodeTime = (default_timer() - start) / number
+
+			results.append((codec.name, name, len(encoded), encodeTime * 1e6, decodeTime * 1e6))
+
+	return results
+
+
+class Error (Exception):
+	pass
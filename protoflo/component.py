@@ -30,6 +30,9 @@ class Component (EventEmitter):
 	inPorts = None
 	outPorts = None
 
+	# Set by the network running the component, see track()
+	tracker = None
+
 	def __init__ (self, inPorts = None, outPorts = None, metadata = None, icon = None, **options):
 		if isinstance(inPorts, InPorts):
 			self.inPorts = inPorts
@@ -87,6 +90,34 @@ class Component (EventEmitter):
 	def initialize (self, **options):
 		pass
 
+	def track (self, d):
+		"""Tell the network about asynchronous work of this component.
+
+		The network does not end before the Deferred [d] fires. Callbacks
+		must be added to the returned Deferred rather than to [d], so that
+		packets they send are accounted for too.
+		"""
+
+		if self.tracker is None:
+			return d
+
+		return self.tracker(d)
+
+	def deferToThread (self, f, *args, **kwargs):
+		""" Run [f] in a thread, keeping the network running meanwhile. """
+		return self.track(threads.deferToThread(f, *args, **kwargs))
+
+	def getState (self):
+		"""Return the state to save in network checkpoints, or None.
+
+		Components keeping state between packets implement this and
+		setState() to survive being checkpointed and restored."""
+
+		return None
+
+	def setState (self, state):
+		pass
+
 	def shutdown (self):
 		pass
 
@@ -94,6 +125,7 @@ class Component (EventEmitter):
 class ComponentLoader (EventEmitter):
 	processing = False
 	components = None
+	token = None
 	ready = False
 
 	def listComponents (self):
@@ -119,6 +151,12 @@ class ComponentLoader (EventEmitter):
 				for component in collection.components:
 					self.components[component.componentName] = component
 
+			# Identifies this set of components, eg for cached execution plans
+			self.token = hash(tuple(sorted(
+				(c.componentName, c.objectName or c.fileName)
+				for c in self.components.itervalues()
+			)))
+
 			d.callback(self.components)
 			
 			self.processing = False
@@ -142,19 +180,9 @@ class ComponentLoader (EventEmitter):
 			return d
 
 		try:
-			component = self.components[name]
+			name, component = self.resolve(name)
 		except KeyError:
-			# try a short-name lookup
-			for key in self.components.iterkeys():
-				parts = key.split('/')
-				# note: currently only the builtin Graph component within
-				# protoflo.__init__ has no collection name
-				if len(parts) == 2 and parts[1] == name:
-					component = self.components[key]
-					name = key
-					break
-			else:
-				return defer.fail(Error("Component {:s} not available".format(name)))
+			return defer.fail(Error("Component {:s} not available".format(name)))
 
 		# TODO: deal with graphs / getComponent function / string values
 		componentClass = component.load()
@@ -163,6 +191,26 @@ class ComponentLoader (EventEmitter):
 
 		return defer.succeed(componentObject)
 
+	def resolve (self, name):
+		"""Find a listed component by its full or short name
+
+		@return: (full name, L{CachedComponent}) tuple.
+		@raise KeyError: if no such component was listed.
+		"""
+
+		try:
+			return name, self.components[name]
+		except KeyError:
+			# try a short-name lookup
+			for key in self.components.iterkeys():
+				parts = key.split('/')
+				# note: currently only the builtin Graph component within
+				# protoflo.__init__ has no collection name
+				if len(parts) == 2 and parts[1] == name:
+					return key, self.components[key]
+
+			raise
+
 	def setIcon (self, name, instance):
 		if instance.icon is not None:
 			return
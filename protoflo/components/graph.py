@@ -123,10 +123,10 @@ class Graph (Component):
 		if self.network is None:
 			return
 
-		self.network.sendInitials()
+		self.network.start()
 
 		if graph is not None:
-			graph.on('addInitial', lambda _: self.network.sendInitials())
+			graph.on('addInitial', lambda _: self.network.connections.sendInitials())
 
 	def _isExported (self, port, nodeName, portName, _ports, _add):
 		# First we check disambiguated exported ports
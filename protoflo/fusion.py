@@ -0,0 +1,515 @@
+import functools
+
+# Fusion collapses chains of map components (see helper.MapComponent)
+# connected one to one into a single process. The head of a chain calls the
+# map functions of the following nodes directly, instead of going through
+# the sockets and port events between them. Groups are forwarded to the
+# tail once for the whole chain, and each map function still gets the
+# groups open on its own node.
+#
+# Regions of math components (see protoflo_math) feeding each other are
+# fused too, into a single expression compiled to Python code, evaluated
+# when a packet arrives at any operand port on the edge of the region.
+#
+# Fusion is reversible: the sockets inside a chain stay attached, and
+# unfusing puts the original process of the head back.
+
+
+def mappable (component):
+	""" Whether a component is a map component which may be fused. """
+
+	if getattr(component, "mapFunction", None) is None:
+		return False
+
+	inName, outName = component.mapPorts
+	inPort = component.inPorts[inName]
+	outPort = component.outPorts[outName]
+
+	return not (inPort.buffered or inPort.addressable or outPort.addressable)
+
+
+def findChains (network):
+	"""Find the chains of map components of a network which can be fused.
+
+	@return: C{list} of chains, each a list of L{network.Process}es.
+	"""
+
+	edges = network.connections
+	processes = network.processes.processes
+	following = {}
+
+	for socket, (srcKey, tgtKey) in edges.connections.iteritems():
+		if srcKey is None or socket in network.traced:
+			continue
+
+		src = processes.get(srcKey[0])
+		tgt = processes.get(tgtKey[0])
+
+		if src is None or tgt is None or src is tgt \
+		or not (mappable(src.component) and mappable(tgt.component)):
+			continue
+
+		# Only single edges between the mapped ports of both nodes
+		if srcKey[1] != src.component.mapPorts[1] or tgtKey[1] != tgt.component.mapPorts[0]:
+			continue
+
+		outPort = src.component.outPorts[srcKey[1]]
+		inPort = tgt.component.inPorts[tgtKey[1]]
+
+		if len(outPort.sockets) != 1 or len(inPort.sockets) != 1:
+			continue
+
+		# Somebody else is interested in the packets arriving there
+		if any(len(inPort.listeners(event)) for event in ('connect', 'begingroup', 'data', 'endgroup', 'disconnect')):
+			continue
+
+		if inPort.process is not tgt.component.mapProcess:
+			continue
+
+		following[src.id] = (tgt, socket)
+
+	targets = set(tgt.id for tgt, socket in following.itervalues())
+	chains = []
+
+	for id in following:
+		if id in targets:
+			continue
+
+		chain = [processes[id]]
+		sockets = []
+
+		while chain[-1].id in following:
+			tgt, socket = following[chain[-1].id]
+			chain.append(tgt)
+			sockets.append(socket)
+
+		chains.append(FusedChain(chain, sockets))
+
+	return chains
+
+
+class Link (object):
+	"""Stands for the outport of a node inside a fused chain: packets sent
+	to it go to the map function of the next node, or out of the chain."""
+
+	def __init__ (self, stats, function = None, state = None, next = None, outPort = None):
+		self.stats = stats
+		self.function = function
+		self.state = state
+		self.next = next
+		self.outPort = outPort
+
+	def send (self, data, socketId = None):
+		self.stats["out"] += 1
+
+		if self.outPort is not None:
+			return self.outPort.send(data)
+
+		self.next.stats["in"] += 1
+		self.function({ "data": data }, self.state["groups"], self.next)
+
+	# Brackets sent by map functions themselves leave the chain directly
+
+	def connect (self, socketId = None):
+		self.tail().connect()
+
+	def beginGroup (self, group, socketId = None):
+		self.tail().beginGroup(group)
+
+	def endGroup (self, socketId = None):
+		self.tail().endGroup()
+
+	def disconnect (self, socketId = None):
+		self.tail().disconnect()
+
+	def tail (self):
+		link = self
+
+		while link.outPort is None:
+			link = link.next
+
+		return link.outPort
+
+
+class FusedChain (object):
+	"""
+	@type nodes: C{list}
+	@ivar nodes: L{network.Process}es of the chain, head first.
+
+	@type sockets: C{list}
+	@ivar sockets: The sockets bypassed by the chain.
+
+	@type stats: C{dict}
+	@ivar stats: Node id to the number of packets that went "in" and "out"
+		of the node while fused.
+	"""
+
+	def __init__ (self, nodes, sockets):
+		self.nodes = nodes
+		self.sockets = sockets
+		self.stats = dict((node.id, { "in": 0, "out": 0 }) for node in nodes)
+		self.installed = False
+
+	def install (self):
+		components = [node.component for node in self.nodes]
+		head = components[0]
+		tail = components[-1]
+
+		inPort = head.inPorts[head.mapPorts[0]]
+		outPort = tail.outPorts[tail.mapPorts[1]]
+		states = [component.mapState for component in components]
+
+		# Links are built backwards, each one leading to the next node
+		link = Link(self.stats[self.nodes[-1].id], outPort = outPort)
+		for node, component in reversed(zip(self.nodes[:-1], components[1:])):
+			link = Link(self.stats[node.id], component.mapFunction, component.mapState, link)
+
+		function = head.mapFunction
+		headStats = self.stats[self.nodes[0].id]
+
+		def process (event, nodeInstance, data):
+			if event == 'data':
+				headStats["in"] += 1
+				function(data, states[0]['groups'], link)
+			elif event == 'connect':
+				outPort.connect()
+			elif event == 'begingroup':
+				for state in states:
+					state['groups'].append(data["group"])
+				outPort.beginGroup(data["group"])
+			elif event == 'endgroup':
+				for state in states:
+					state['groups'].pop()
+				outPort.endGroup()
+			elif event == 'disconnect':
+				for state in states:
+					state['groups'] = []
+				outPort.disconnect()
+
+		inPort.process = process
+		self.installed = True
+
+	def remove (self):
+		if not self.installed:
+			return
+
+		head = self.nodes[0].component
+		head.inPorts[head.mapPorts[0]].process = head.mapProcess
+		self.installed = False
+
+	def sync (self):
+		# Map components keep their state themselves
+		pass
+
+
+def expressible (component):
+	""" Whether a component is a math component which may be fused. """
+
+	ports = getattr(component, "expressionPorts", None)
+	if ports is None:
+		return False
+
+	primary, secondary, result = ports
+
+	for name, port in component.inPorts.iteritems():
+		if name in (primary, secondary):
+			if port.buffered or port.addressable:
+				return False
+
+		# Other ports would change the component behind the expression
+		elif port.attached and name not in component.expressionOptions:
+			return False
+
+	return not component.outPorts[result].addressable
+
+
+def findExpressions (network):
+	"""Find the regions of math components of a network which can be fused.
+
+	@return: C{list} of L{FusedExpression}s.
+	"""
+
+	edges = network.connections
+	processes = network.processes.processes
+	feeding = {}
+	feeds = set()
+
+	for socket, (srcKey, tgtKey) in edges.connections.iteritems():
+		if srcKey is None or socket in network.traced:
+			continue
+
+		src = processes.get(srcKey[0])
+		tgt = processes.get(tgtKey[0])
+
+		if src is None or tgt is None or src is tgt \
+		or not (expressible(src.component) and expressible(tgt.component)):
+			continue
+
+		if srcKey[1] != src.component.expressionPorts[2] or tgtKey[1] not in tgt.component.expressionPorts[:2]:
+			continue
+
+		outPort = src.component.outPorts[srcKey[1]]
+		inPort = tgt.component.inPorts[tgtKey[1]]
+
+		if len(outPort.sockets) != 1 or len(inPort.sockets) != 1:
+			continue
+
+		feeding[tgt.id, tgtKey[1]] = (src, socket)
+		feeds.add(src.id)
+
+	# Regions are trees, found from their root. Nodes feeding each other in
+	# a cycle have no root and are left alone.
+	roots = set(id for id, port in feeding if id not in feeds)
+
+	return [FusedExpression(processes[id], feeding) for id in roots]
+
+
+class Operand (object):
+	"""An operand port on the edge of a fused expression. Primary operands
+	keep track of the groups and disconnections of their port, which the
+	result inherits."""
+
+	def __init__ (self, node, port, primary):
+		self.node = node
+		self.port = port
+		self.primary = primary
+		self.value = None
+		self.groups = []
+		self.snapshot = []
+		self.disconnect = False
+
+
+class Step (object):
+	""" A node of a fused expression, to evaluate it one node at a time. """
+
+	def __init__ (self, node, primary, secondary):
+		self.node = node
+		self.primary = primary
+		self.secondary = secondary
+		self.value = None
+
+		# The operand whose groups go along with the result
+		spine = primary
+		while isinstance(spine, Step):
+			spine = spine.primary
+
+		self.spine = spine
+
+
+class FusedExpression (object):
+	"""
+	@type nodes: C{list}
+	@ivar nodes: L{network.Process}es of the region, root last.
+
+	@type sockets: C{list}
+	@ivar sockets: The sockets bypassed by the expression.
+
+	@type source: C{str}
+	@ivar source: Python source of the compiled expression.
+
+	@type stats: C{dict}
+	@ivar stats: Node id to the number of packets that went "in" and "out"
+		of the node while fused.
+	"""
+
+	primaryEvents = ('begingroup', 'data', 'endgroup', 'disconnect')
+	secondaryEvents = ('data',)
+
+	def __init__ (self, root, feeding):
+		self.nodes = []
+		self.sockets = []
+		self.operands = []
+		self.steps = []
+		self.functions = {}
+
+		body = self._build(root, feeding)
+		self.source = "lambda {:s}: {:s}".format(
+			", ".join("v{:d}".format(i) for i in xrange(len(self.operands))),
+			body
+		)
+		self.function = eval(self.source, self.functions)
+		self.stats = dict((node.id, { "in": 0, "out": 0 }) for node in self.nodes)
+		self.listeners = []
+		self.installed = False
+
+	def _build (self, node, feeding):
+		# Nodes are listed in evaluation order, each after its operands
+		component = node.component
+		primary, secondary, result = component.expressionPorts
+		sources = []
+		refs = []
+
+		for port in (primary, secondary):
+			if (node.id, port) in feeding:
+				child, socket = feeding[node.id, port]
+				self.sockets.append(socket)
+				sources.append(self._build(child, feeding))
+				refs.append(self.steps[-1])
+			else:
+				operand = Operand(node, component.inPorts[port], port == primary)
+				sources.append("v{:d}".format(len(self.operands)))
+				refs.append(operand)
+				self.operands.append(operand)
+
+		self.nodes.append(node)
+		self.steps.append(Step(node, *refs))
+
+		if component.expressionOperator is None:
+			name = "f{:d}".format(len(self.functions))
+			self.functions[name] = component.calculate
+			return "{:s}({:s}, {:s})".format(name, *sources)
+
+		return "({:s} {:s} {:s})".format(sources[0], component.expressionOperator, sources[1])
+
+	def install (self):
+		root = self.steps[-1]
+		outPort = root.node.component.outPorts[root.node.component.expressionPorts[2]]
+		operands = self.operands
+		values = [None] * len(operands)
+		function = self.function
+		nodeStats = [self.stats[node.id] for node in self.nodes]
+
+		# Packets the components received before being fused are kept
+		for i, operand in enumerate(operands):
+			state = operand.node.component.getState()
+
+			if operand.primary:
+				operand.value = state["primary"]["value"]
+				operand.groups = list(state["groups"])
+				operand.snapshot = list(state["primary"]["group"])
+				operand.disconnect = state["primary"]["disconnect"]
+			else:
+				operand.value = state["secondary"]
+
+			values[i] = operand.value
+
+		missing = [sum(1 for value in values if value is None)]
+
+		def evaluate ():
+			# Sequences are left to the components, which cast them
+			if any(isinstance(value, (list, tuple)) for value in values):
+				return self.evaluate(report = True)
+
+			try:
+				return function(*values)
+			except Exception:
+				# Again one node at a time, to blame the right one
+				return self.evaluate(report = True)
+
+		def send (result):
+			spine = root.spine
+
+			for group in spine.snapshot:
+				outPort.beginGroup(group)
+
+			if outPort.attached:
+				outPort.send(result)
+
+			for group in spine.snapshot:
+				outPort.endGroup()
+
+			if outPort.connected and spine.disconnect:
+				outPort.disconnect()
+
+		def handler (i, event, data):
+			operand = operands[i]
+
+			if event == 'data':
+				self.stats[operand.node.id]["in"] += 1
+
+				wasMissing = values[i] is None
+				operand.value = values[i] = operand.node.component.operand(data['data'])
+				missing[0] += (values[i] is None) - wasMissing
+
+				if operand.primary:
+					operand.snapshot = operand.groups[:]
+					operand.disconnect = False
+
+				if missing[0]:
+					return
+
+				result = evaluate()
+
+				if result is not None:
+					for stats in nodeStats:
+						stats["out"] += 1
+
+					send(result)
+			elif event == 'begingroup':
+				operand.groups.append(data['group'])
+			elif event == 'endgroup':
+				operand.groups.pop()
+			elif event == 'disconnect':
+				operand.disconnect = True
+
+				if operand is root.spine:
+					outPort.disconnect()
+
+		for i, operand in enumerate(operands):
+			port = operand.port
+
+			for event in (self.primaryEvents if operand.primary else self.secondaryEvents):
+				listener = functools.partial(handler, i, event)
+				self.listeners.append((port, event, list(port.listeners(event)), listener))
+				port.off(event)
+				port.on(event, listener)
+
+		self.installed = True
+
+	def evaluate (self, report = False):
+		"""Evaluate the expression one node at a time, through the compute()
+		of each component.
+
+		@return: the result, or None if an operand is missing or a node
+			failed. Failures are passed to the component when [report].
+		"""
+
+		for step in self.steps:
+			a = step.primary.value
+			b = step.secondary.value
+			step.value = None
+
+			if a is None or b is None:
+				continue
+
+			try:
+				step.value = step.node.component.compute(a, b)
+			except Exception as e:
+				if report:
+					step.node.component.computeFailed(e)
+					return None
+
+		return self.steps[-1].value
+
+	def sync (self):
+		""" Hand the operands of every node back to its component. """
+
+		self.evaluate()
+
+		for step in self.steps:
+			spine = step.spine
+
+			step.node.component.setState({
+				"primary": {
+					"value": step.primary.value,
+					"group": list(spine.snapshot),
+					"disconnect": spine.disconnect
+				},
+				"secondary": step.secondary.value,
+				"groups": list(step.primary.groups) if isinstance(step.primary, Operand) else []
+			})
+
+	def remove (self):
+		if not self.installed:
+			return
+
+		self.sync()
+
+		for port, event, listeners, listener in self.listeners:
+			port.off(event, listener)
+
+			for function in listeners:
+				port.on(event, function)
+
+		self.listeners = []
+		self.installed = False
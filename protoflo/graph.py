@@ -1,7 +1,8 @@
 from twisted.internet import defer
 
-from util import EventEmitter
+from util import EventEmitter, atomicWrite
 
+from itertools import chain
 import copy
 import os
 
@@ -20,13 +21,19 @@ class Graph (EventEmitter):
 		self.groups = Groups(self)
 		self.transaction = {
 			"id": None,
-			"depth": 0
+			"depth": 0,
+			"changes": []
 		}
 
+		# Dirty tracking: every recorded change bumps the revision
+		self.revision = 0
+		self.savedRevision = 0
+
 		def _event (type):
 			def event (eventName, data):
 				import sys
 				print>>sys.stdout, "-"*20, eventName, type
+				self.recordChange(eventName + type, data)
 				self.emit(eventName + type, **data)
 
 			return event
@@ -37,6 +44,7 @@ class Graph (EventEmitter):
 		self.initials.on("all", _event("Initial"))
 		self.inports.on("all", _event("Inport"))
 		self.outports.on("all", _event("Outport"))
+		self.groups.on("all", _event("Group"))
 
 	def startTransaction (self, id, metadata = None):
 		if self.transaction["id"] is not None:
@@ -51,10 +59,30 @@ class Graph (EventEmitter):
 		if self.transaction["id"] is None:
 			raise Error("Attempted to end non-existing transaction")
 
+		changes = self.transaction["changes"]
+
 		self.transaction["id"] = None
 		self.transaction["depth"] = 0
+		self.transaction["changes"] = []
+
+		# Deliver everything that happened inside the transaction in one go,
+		# so that subscribers (eg the Network) can apply it as a batch
+		if len(changes):
+			self.emit('changeSet', transaction = id, metadata = metadata, changes = changes)
+
 		self.emit('endTransaction', transaction = id, metadata = metadata)
 
+	def recordChange (self, event, data):
+		"""Collect a change for the change set of the current transaction"""
+
+		self.revision += 1
+
+		if self.transaction["id"] is not None:
+			self.transaction["changes"].append({
+				"event": event,
+				"data": data
+			})
+
 	def checkTransactionStart (self):
 		if self.transaction["id"] is None:
 			self.startTransaction("implicit")
@@ -77,6 +105,7 @@ class Graph (EventEmitter):
 		for item, val in properties.iteritems():
 			self.properties[item] = val
 
+		self.recordChange('changeProperties', { "properties": self.properties, "old": before })
 		self.emit('changeProperties', properties = self.properties, old = before)
 		self.checkTransactionEnd()
 		
@@ -113,89 +142,183 @@ class Graph (EventEmitter):
 	# 	self.emit('removeExport', found = found)
 	# 	self.checkTransactionEnd()
 
+	@property
+	def dirty (self):
+		"""Whether the graph changed since it was last saved"""
+		return self.revision != self.savedRevision
+
+	def _processJSON (self, node):
+		process = {
+			"component": node["component"]
+		}
+
+		if len(node["metadata"]):
+			process["metadata"] = node["metadata"]
+
+		return process
+
+	def _groupJSON (self, group):
+		groupData = {
+			"name": group["name"],
+			"nodes": group["nodes"]
+		}
+
+		if group["metadata"]:
+			groupData["metadata"] = group["metadata"]
+
+		return groupData
+
+	def _connectionJSON (self, edge):
+		connection = {
+			"src": {
+				"process": edge["src"]["node"],
+				"port":    edge["src"]["port"],
+				"index":   edge["src"]["index"]
+			},
+			"tgt": {
+				"process": edge["tgt"]["node"],
+				"port":    edge["tgt"]["port"],
+				"index":   edge["tgt"]["index"]
+			}
+		}
+
+		if len(edge["metadata"]):
+			connection["metadata"] = edge["metadata"]
+
+		return connection
+
+	def _initialJSON (self, initial):
+		return {
+			"data": initial["src"]["data"],
+			"tgt": {
+				"process": initial["tgt"]["node"],
+				"port":    initial["tgt"]["port"],
+				"index":   initial["tgt"]["index"]
+			}
+		}
+
+	def _propertiesJSON (self):
+		properties = dict(self.properties)
+
+		if self.name != "":
+			properties["name"] = self.name
+
+		return properties
+
 	def toJSON (self):
 		json = {
-			"properties": {},
-			"inports": {},
-			"outports": {},
-			"groups": [],
+			"properties": self._propertiesJSON(),
+			"inports": dict(self.inports.iteritems()),
+			"outports": dict(self.outports.iteritems()),
+			"groups": [self._groupJSON(group) for group in self.groups],
 			"processes": {},
 			"connections": []
 		}
 
-		if self.name != "":
-			json["properties"]["name"] = self.name
+		# Legacy exported ports
+		if len(self.exports):
+			json["exports"] = copy.deepcopy(self.exports)
+
+		for node in self.nodes:
+			json["processes"][node["id"]] = self._processJSON(node)
+
+		for edge in self.edges:
+			json["connections"].append(self._connectionJSON(edge))
+
+		for initial in self.initials:
+			json["connections"].append(self._initialJSON(initial))
+
+		return json
+
+	def iterJSON (self, indent = 4):
+		"""Serialise the graph as a stream of JSON chunks.
+
+		Produces the same document as toJSON(), one process or connection
+		per line, without building the whole document in memory first."""
+
+		from json import JSONEncoder
+
+		pad = " " * indent
+		encode = JSONEncoder().encode
+
+		def mapping (key, items, last = False):
+			yield '{:s}"{:s}": {{'.format(pad, key)
+
+			separator = "\n"
+			for name, value in items:
+				yield '{:s}{:s}{:s}{:s}: {:s}'.format(separator, pad, pad, encode(name), encode(value))
+				separator = ",\n"
+
+			yield "\n{:s}}}{:s}\n".format(pad, "" if last else ",")
+
+		def sequence (key, items, last = False):
+			yield '{:s}"{:s}": ['.format(pad, key)
 
-		for property, value in self.properties.iteritems():
-			json["properties"][property] = value
+			separator = "\n"
+			for value in items:
+				yield '{:s}{:s}{:s}{:s}'.format(separator, pad, pad, encode(value))
+				separator = ",\n"
 
-		for key, port in self.inports.iteritems():
-			json["inports"][key] = port
-		for key, port in self.outports.iteritems():
-			json["outports"][key] = port
+			yield "\n{:s}]{:s}\n".format(pad, "" if last else ",")
+
+		yield "{\n"
+		yield '{:s}"properties": {:s},\n'.format(pad, encode(self._propertiesJSON()))
+
+		for chunk in mapping("inports", self.inports.iteritems()):
+			yield chunk
+
+		for chunk in mapping("outports", self.outports.iteritems()):
+			yield chunk
 
 		# Legacy exported ports
 		if len(self.exports):
-			json["exports"] = copy.deepcopy(self.exports)
+			for chunk in sequence("exports", self.exports):
+				yield chunk
 
-		for group in self.groups:
-			groupData = {
-				"name": group["name"],
-				"nodes": group["nodes"]
-			}
+		for chunk in sequence("groups", (self._groupJSON(group) for group in self.groups)):
+			yield chunk
 
-			if len(group["metadata"]):
-				groupData["metadata"] = copy.deepcopy(group["metadata"])
+		for chunk in mapping("processes", ((node["id"], self._processJSON(node)) for node in self.nodes)):
+			yield chunk
 
-			json.groups.append(groupData)
+		connections = chain(
+			(self._connectionJSON(edge) for edge in self.edges),
+			(self._initialJSON(initial) for initial in self.initials)
+		)
 
-		for node in self.nodes:
-			json["processes"][node["id"]] = {
-				"component": node["component"]
-			}
+		for chunk in sequence("connections", connections, last = True):
+			yield chunk
 
-			if len(node["metadata"]):
-				json["processes"][node["id"]]["metadata"] = node["metadata"]
+		yield "}\n"
 
-		for edge in self.edges:
-			connection = {
-				"src": {
-					"process": edge["src"]["node"],
-					"port":    edge["src"]["port"],
-					"index":   edge["src"]["index"]
-				},
-				"tgt": {
-					"process": edge["tgt"]["node"],
-					"port":    edge["tgt"]["port"],
-					"index":   edge["tgt"]["index"]
-				}
-			}
+	def save (self, file, success = None):
+		"""Write the graph to a .json file.
 
-			if len(edge["metadata"]):
-				connection["metadata"] = edge["metadata"]
+		The file is replaced atomically, so an interrupted save never leaves
+		a truncated graph behind.
 
-			json["connections"].append(connection)
+		@return: Deferred firing with the name of the written file.
+		"""
 
-		for initial in self.initials:
-			json["connections"].append({
-				"data": initial["src"]["data"],
-				"tgt": {
-					"process": initial["tgt"]["node"],
-					"port":    initial["tgt"]["port"],
-					"index":   initial["tgt"]["index"]
-				}
-			})
+		if not file.endswith(".json"):
+			file = "{:s}.json".format(file)
 
-		return json
+		revision = self.revision
+		atomicWrite(file, self.iterJSON())
+		self.savedRevision = revision
+
+		if success is not None:
+			success(file)
+
+		return defer.succeed(file)
+
+	def autosave (self, file):
+		"""Save the graph only if it changed since the last save"""
 
-	def save (self, file, success):
-		from json import dumps
-		json = dumps(self.toJSON(), indent = 4)
-		# FIXME: I think this should call .format(file)
-		with open("{:s}.json", 'r') as f:
-			f.write(json)
+		if not self.dirty:
+			return defer.succeed(None)
 
-		return defer.succeed(None)
+		return self.save(file)
 
 
 
@@ -596,7 +719,7 @@ class Edges (EventEmitter):
 
 		return edge
 
-	def remove (self, srcNode, srcPort = None, tgtNode = None, tgtPport = None):
+	def remove (self, srcNode, srcPort = None, tgtNode = None, tgtPort = None):
 		"""Disconnect nodes
 		
 		Connections between nodes can be removed by providing the
@@ -1,6 +1,13 @@
 
 # MapComponent maps a single inport to a single outport, forwarding all
-# groups from in to out and calling `func` on each incoming packet
+# groups from in to out and calling `func` on each incoming packet.
+#
+# The function, ports and group state are kept on the component, so that
+# chains of map components can be fused into one process (see fusion).
+#
+# Functions which don't look at the groups open (config "groups": False)
+# skip the bracket bookkeeping: brackets are forwarded as they come, and
+# packets handled with no group list at all.
 def MapComponent (component, func, config = None):
 	config = config or {}
 
@@ -17,13 +24,14 @@ def MapComponent (component, func, config = None):
 	}
 
   	def process (event, nodeInstance, data):
-		if event == 'connect':
+		# Packets first: streams without groups pay nothing for brackets
+		if event == 'data':
+			func(data, _['groups'], outPort)
+		elif event == 'connect':
 			outPort.connect()
 		elif event == 'begingroup':
-			_['groups'].push(data["group"])
+			_['groups'].append(data["group"])
 			outPort.beginGroup(data["group"])
-		elif event == 'data':
-			func(data, _['groups'], outPort)
 		elif event == 'endgroup':
 			_['groups'].pop()
 			outPort.endGroup()
@@ -31,6 +39,26 @@ def MapComponent (component, func, config = None):
 			_['groups'] = []
 			outPort.disconnect()
 
+	def forward (event, nodeInstance, data):
+		if event == 'data':
+			func(data, (), outPort)
+		elif event == 'connect':
+			outPort.connect()
+		elif event == 'begingroup':
+			outPort.beginGroup(data["group"])
+		elif event == 'endgroup':
+			outPort.endGroup()
+		elif event == 'disconnect':
+			outPort.disconnect()
+
+	if not config.get("groups", True):
+		process = forward
+
 	inPort.process = process
 
+	component.mapFunction = func
+	component.mapPorts = (config["inPort"], config["outPort"])
+	component.mapState = _
+	component.mapProcess = process
+
 	return component
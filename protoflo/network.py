@@ -1,12 +1,18 @@
 from twisted.internet import reactor, defer
-from twisted.python import failure
+from twisted.python import failure, log
 
-from util import EventEmitter, debounce
+from util import EventEmitter, atomicWrite
 from socket import InternalSocket
 from component import ComponentLoader
+from port import PortCache
+import graph as graphModule
+import fusion
+import plan
+import validation
 
-from collections import deque
+from collections import deque, OrderedDict
 from datetime import datetime
+import cPickle as pickle
 import functools
 
 class Network (EventEmitter):
@@ -43,6 +49,19 @@ class Network (EventEmitter):
 		self.processes = Processes(self, self.loader)
 		self.connections = Edges(self)
 		self.graph = graph
+		self.plan = None
+		self.traced = {}
+		self.fused = {}
+		self.cache = PortCache(self.cacheBytes)
+		self.validationStats = validation.Stats()
+
+		# Inports with a default value not delivered yet
+		self.defaults = OrderedDict()
+		self.started = False
+
+		# Networks sharing a scheduler are accounted per tenant; subgraphs
+		# take the tenant of the network they run in
+		self.tenant = self
 
 		self.startupDate = datetime.now()
 
@@ -53,6 +72,28 @@ class Network (EventEmitter):
 	running = False
 	connectionCount = 0
 
+	# Work the network knows to be in flight besides open connections:
+	# IIPs being sent, deferreds and threads tracked by components, etc.
+	pending = 0
+
+	# Maximum number of components loading at the same time
+	concurrency = 16
+
+	# Shares the reactor with other networks when set, see callSoon()
+	scheduler = None
+
+	# Whether chains of map components and regions of math components are
+	# fused when wiring, see fusion
+	fuse = False
+
+	# Memory available to the packets cached by caching outports
+	cacheBytes = 16 * 1024 * 1024
+
+	# How packets arriving at inports are validated, see validation. In
+	# "sampled" mode, one packet in validationSample is checked.
+	validationMode = "off"
+	validationSample = 100
+
 	def increaseConnections (self):
 		if self.connectionCount == 0 and not self.running:
 			self.running = True # Otherwise can get multiple start events during IIP sending.
@@ -62,13 +103,77 @@ class Network (EventEmitter):
 
 	def decreaseConnections (self):
 		self.connectionCount -= 1
+		self._checkEnd()
+
+	# Packets are delivered synchronously: by the time a disconnect reaches
+	# the network, the components downstream have already reacted to it and
+	# opened their own connections. The network is therefore finished
+	# exactly when no connection is open and nothing else is pending.
+
+	def hold (self):
+		""" Keep the network from ending until release() is called. """
+		self.pending += 1
+
+	def release (self):
+		self.pending -= 1
+		self._checkEnd()
+
+	def track (self, d):
+		"""Keep the network running until the Deferred [d] fires.
+
+		@return: a Deferred firing with the result of [d]. Callbacks added
+			to it run before the network may end.
+		"""
+
+		tracked = defer.Deferred()
+		self.hold()
+
+		def fire (result):
+			try:
+				tracked.callback(result)
+			finally:
+				self.release()
 
-		if self.connectionCount == 0:
-			self._end()
+		def schedule (result):
+			if self.scheduler is None:
+				fire(result)
+			else:
+				self.scheduler.schedule(self.tenant, fire, result)
+
+		d.addBoth(schedule)
+		return tracked
+
+	def callSoon (self, f, *args, **kwargs):
+		""" Run f(*args, **kwargs) on the next turn of the network. """
+
+		if self.scheduler is None:
+			reactor.callLater(0, f, *args, **kwargs)
+		else:
+			self.scheduler.schedule(self.tenant, f, *args, **kwargs)
+
+	def gate (self, socket):
+		"""Installed on the sockets of the network. When it shares a
+		scheduler, events sent outside of a turn of the network, or once
+		its turn is used up, wait in their socket for the next one."""
+
+		scheduler = self.scheduler
+
+		if scheduler is None or scheduler.running(self.tenant):
+			return
+
+		socket.pause()
+		self.hold()
+
+		def resume ():
+			try:
+				socket.resume()
+			finally:
+				self.release()
 
-	@debounce(0.01)
-	def _end (self):
-		if self.connectionCount:
+		scheduler.schedule(self.tenant, resume)
+
+	def _checkEnd (self):
+		if self.connectionCount or self.pending or not self.running:
 			return
 
 		self.running = False
@@ -82,21 +187,75 @@ class Network (EventEmitter):
 	def load (self, component, metadata = None):
 		return self.loader.load(component, metadata)
 
+	def compile (self):
+		"""Return the execution plan of the graph, compiling it if needed.
+		The components must have been listed by the loader beforehand."""
+
+		self.plan = plan.getPlan(self.graph, self.loader)
+		return self.plan
+
 	@defer.inlineCallbacks
 	def connect (self):
-		for node in self.graph.nodes:
-			yield self.processes.add(**node)
+		try:
+			executionPlan = self.compile()
+		except plan.Error as e:
+			raise Error(str(e))
 
-		for edge in self.graph.edges:
-			yield self.connections.add(**edge)
+		nodes = dict((node["id"], node) for node in self.graph.nodes)
 
-		for iip in self.graph.initials:
-			yield self.connections.addInitial(**iip)
+		# Components are loaded concurrently, and every connection is made
+		# as soon as both of its ends are available
+		loads = self.loadProcesses(
+			(id, executionPlan.components[id], nodes[id]["metadata"])
+			for id in executionPlan.order
+		)
+
+		wires = []
+		for connection in executionPlan.connections():
+			wires.append(self._whenLoaded(
+				loads,
+				(connection.src.node, connection.tgt.node),
+				self.connections.add,
+				connection.src._asdict(),
+				connection.tgt._asdict(),
+				connection.metadata
+			))
+
+		try:
+			yield defer.gatherResults(loads.values() + wires, consumeErrors = True)
+		except defer.FirstError as e:
+			e.subFailure.raiseException()
+
+		for initial in executionPlan.initials:
+			yield self.connections.addInitial({ "data": initial.data }, initial.tgt._asdict(), initial.metadata)
+
+		if self.fuse:
+			self.fuseChains()
 
 		self.subscribeGraph()
 
 		defer.returnValue(self)
 
+	def loadProcesses (self, nodes):
+		"""Add processes, loading at most [concurrency] components at a time
+
+		@type nodes: iterable
+		@param nodes: (id, component, metadata) tuples.
+
+		@return: C{dict} of node id to the Deferred of its process.
+		"""
+
+		semaphore = defer.DeferredSemaphore(self.concurrency)
+
+		return OrderedDict(
+			(id, semaphore.run(self.processes.add, id, component, metadata))
+			for id, component, metadata in nodes
+		)
+
+	def _whenLoaded (self, loads, nodes, f, *args):
+		waiting = [loads[node] for node in set(nodes) if node in loads]
+		return defer.gatherResults(waiting).addCallback(lambda _: f(*args))
+
 	def connectPort (self, socket, process, port, index, inbound):
 		if inbound == True:
 			socket.tgt = {
@@ -110,10 +269,23 @@ class Network (EventEmitter):
 			except (AttributeError, KeyError):
 				raise Error ("No inport '{:s}' defined in process {:s} ({:s})".format(port, process.id, socket.id))
 
-			if process.component.inPorts[port].addressable:
-				return process.component.inPorts[port].attach(socket, index)
+			inPort = process.component.inPorts[port]
+			self.installValidator(inPort)
+
+			if inPort.addressable:
+				inPort.attach(socket, index)
+			else:
+				inPort.attach(socket)
 
-			return process.component.inPorts[port].attach(socket)
+			# Once started, ports wired by graph changes get their default
+			# on their own
+			if inPort.hasDefault:
+				if self.started:
+					self.callSoon(inPort.sendDefault, socket)
+				else:
+					self.defaults[inPort] = True
+
+			return
 
 		else:
 			socket.src = {
@@ -132,31 +304,145 @@ class Network (EventEmitter):
 
 			return process.component.outPorts[port].attach(socket)
 
-	# Subscribe to events from all connected sockets and re-emit them
+	def setValidation (self, mode):
+		""" Switch the validation mode of the network: strict, sampled or off """
+
+		if mode not in validation.modes:
+			raise Error("Unknown validation mode {:s}".format(mode))
+
+		self.validationMode = mode
+
+		for process in self.processes:
+			if process.component is not None:
+				for port in process.component.inPorts:
+					self.installValidator(port)
+
+	def installValidator (self, port):
+		if self.validationMode == "off":
+			port.validator = None
+			return
+
+		check = validation.compile(port)
+
+		if check is None:
+			port.validator = None
+		else:
+			port.validator = validation.PortValidator(
+				port, check, self.validationStats,
+				self.validationMode, self.validationSample
+			)
+
+	# Keep count of the open connections of every socket. Other socket
+	# events are only re-emitted by the network for traced sockets.
 	def subscribeSocket (self, socket):
-		def socketevent (event, data):
-			if event == "connect":
-				self.increaseConnections()
-			elif event == "disconnect":
-				self.decreaseConnections()
-			
+		socket.on("connect", lambda data: self.increaseConnections())
+		socket.on("disconnect", lambda data: self.decreaseConnections())
+
+	def fuseChains (self):
+		"""Fuse the chains of map components of the network, and the regions
+		of math components into compiled expressions."""
+
+		for chain in fusion.findChains(self) + fusion.findExpressions(self):
+			chain.install()
+
+			for socket in chain.sockets:
+				self.fused[socket] = chain
+
+	def unfuse (self, socket = None):
+		"""Undo the fusion of the chain going through [socket], or of all
+		chains, so that packets travel through their sockets again."""
+
+		if socket is None:
+			chains = set(self.fused.itervalues())
+		elif socket in self.fused:
+			chains = [self.fused[socket]]
+		else:
+			return
+
+		for chain in chains:
+			chain.remove()
+
+			for socket in chain.sockets:
+				del self.fused[socket]
+
+	def fusionStats (self):
+		""" Packets in and out of each fused node, by node id. """
+
+		stats = {}
+
+		for chain in set(self.fused.itervalues()):
+			stats.update(chain.stats)
+
+		return stats
+
+	def traceSocket (self, socket):
+		"""Re-emit the events of a socket on the network.
+
+		Each call must be balanced by a call to untraceSocket(); sockets
+		nobody traces don't pay for the forwarding."""
+
+		# Packets skip the sockets inside fused chains
+		self.unfuse(socket)
+
+		try:
+			self.traced[socket][0] += 1
+			return
+		except KeyError:
+			pass
+
+		def forward (event, data):
 			data["id"] = socket.id
 			data["socket"] = socket
 
 			self.emit(event, **data)
 
+		handlers = []
 		for event in ('connect', 'begingroup', 'data', 'endgroup', 'disconnect'):
-			socket.on(event, functools.partial(socketevent, event))
+			handler = functools.partial(forward, event)
+			socket.on(event, handler)
+			handlers.append((event, handler))
+
+		# Substreams are shown as their groups and packets
+		def forwardSubstream (data):
+			for event, value in data["substream"].events():
+				if event == "data":
+					forward(event, { "data": value })
+				elif event == "begingroup":
+					forward(event, { "group": value })
+				else:
+					forward(event, {})
+
+		socket.on("substream", forwardSubstream)
+		handlers.append(("substream", forwardSubstream))
+
+		self.traced[socket] = [1, handlers]
+
+	def untraceSocket (self, socket, force = False):
+		try:
+			trace = self.traced[socket]
+		except KeyError:
+			return
+
+		trace[0] -= 1
+
+		if force or trace[0] == 0:
+			for event, handler in trace[1]:
+				socket.off(event, handler)
+
+			del self.traced[socket]
 
 	def subscribeGraph (self):
 		# A NoFlo graph may change after network initialization.
-		# For this, the network subscribes to the change events from
-		# the graph.
+		# For this, the network subscribes to the change sets from
+		# the graph: every transaction (explicit or implicit) is
+		# delivered as one list of changes, which is applied as a batch.
 		#
 		# In graph we talk about nodes and edges. Nodes correspond
 		# to NoFlo processes, and edges to connections between them.
 		graphOps = deque()
-		processing = False
+		state = {
+			"processing": False
+		}
 
 		def registerOp (op, details):
 			graphOps.append({
@@ -164,7 +450,7 @@ class Network (EventEmitter):
 				"details": details
 			})
 
-			if not processing:
+			if not state["processing"]:
 				processOps()
 
 		def error (reason):
@@ -175,56 +461,413 @@ class Network (EventEmitter):
 		def processOps (result = None):
 			try:
 				op = graphOps.popleft()
-				processing = True
-				op["op"](*op["details"]).addCallbacks(processOps, error)
-
 			except IndexError:
-				processing = False
-
-		def handler (event, item, op, keys):
-			def subscribeGraphHandler (data):
-				d = data[item]
-				a = []
-
-				for k in keys:
-					try:
-						a.append(d[k])
-					except:
-						a.append(None)
-
-				registerOp(op, a)
-
-			return subscribeGraphHandler
-
-		for event, item, op, keys in (
-			("addNode", "node", self.processes.add, ("id", "component", "metadata")),
-			("removeNode", "node", self.processes.remove, ("id",)),
-			("addEdge", "edge", self.connections.add, ("src", "tgt", "metadata")),
-			("removeEdge", "edge", self.connections.remove, ("src", "tgt")),
-			("addInitial", "edge", self.connections.addInitial, ("src", "tgt", "metadata")),
-			("removeInitial", "edge", self.connections.removeInitial, ("tgt",)),
-		):
-			self.graph.on(event, handler(event, item, op, keys))
-
-		@self.graph.on("renameNode")
+				state["processing"] = False
+				return
+
+			state["processing"] = True
+			op["op"](*op["details"]).addCallbacks(processOps, error)
+
+		@self.graph.on("changeSet")
 		def subscribeGraphHandler (data):
-			registerOp(self.processes.rename, {
-				oldId: data["old"], 
-				newId: data["new"]
-			})
+			registerOp(self.applyChanges, (data["changes"],))
+
+	@defer.inlineCallbacks
+	def applyChanges (self, changes):
+		"""Apply a change set recorded by a graph transaction.
+
+		Consecutive node additions are loaded together, and the edges that
+		follow them are only connected once the whole batch is ready."""
+
+		# Chains are found again once the graph has changed, and the plan
+		# compiled again when next needed
+		self.unfuse()
+		self.plan = None
+
+		loads = []
+
+		for change in changes:
+			if change["event"] == "addNode":
+				node = change["data"]["node"]
+				loads.append((node["id"], node["component"], node["metadata"]))
+				continue
+
+			if len(loads):
+				yield self._applyBatch(loads)
+				loads = []
+
+			try:
+				yield self.applyChange(change["event"], change["data"])
+			except Exception:
+				log.err(None, "Failed to apply {:s}".format(change["event"]))
+
+		if len(loads):
+			yield self._applyBatch(loads)
+
+		if self.fuse:
+			self.fuseChains()
+
+		defer.returnValue(None)
+
+	def _applyBatch (self, loads):
+		def error (reason):
+			log.err(reason.value.subFailure, "Failed to load node")
+
+		loads = self.loadProcesses(loads)
+		return defer.gatherResults(loads.values(), consumeErrors = True).addErrback(error)
+
+	def applyChange (self, event, data):
+		if event == "removeNode":
+			return self.processes.remove(data["node"]["id"])
+		if event == "renameNode":
+			return self.processes.rename(data["old"], data["new"])
+		if event == "addEdge":
+			edge = data["edge"]
+			return self.connections.add(edge["src"], edge["tgt"], edge["metadata"])
+		if event == "removeEdge":
+			edge = data["edge"]
+			return self.connections.remove(edge["src"], edge["tgt"])
+		if event == "addInitial":
+			edge = data["edge"]
+			return self.connections.addInitial(edge["src"], edge["tgt"], edge["metadata"])
+		if event == "removeInitial":
+			return self.connections.removeInitial(data["edge"]["tgt"])
+
+		# Metadata and export changes do not affect the running network
 
 	def start (self):
-		self.connections.sendInitials()
+		""" Send the default values of inports, then the IIPs, on the next
+		turn of the network. """
+		self.started = True
+		return self.connections.sendInitials()
+
+	def sendDefaults (self):
+		defaults = self.defaults
+		self.defaults = OrderedDict()
+
+		for port in defaults:
+			port.sendDefault()
+
+	# Pausing stops the delivery of packets at edge boundaries: whatever is
+	# sent into a connection while the network is paused stays queued in its
+	# socket, in order, until the network resumes. Components finish the
+	# packet they are handling and keep their own state.
+
+	paused = False
+
+	def pause (self):
+		if self.paused:
+			return
+
+		self.paused = True
+
+		# A paused network is not finished, even with no connection open
+		self.hold()
+
+		for socket in self.connections:
+			socket.pause()
+
+		for subnet in self._subnets():
+			subnet.pause()
+
+	def resume (self):
+		if not self.paused:
+			return
+
+		self.paused = False
+
+		for subnet in self._subnets():
+			subnet.resume()
+
+		for socket in list(self.connections):
+			socket.resume()
+
+		self.release()
+
+	def _subnets (self):
+		for process in self.processes:
+			if process.component is not None and process.component.subgraph \
+			and getattr(process.component, "network", None) is not None:
+				yield process.component.network
+
+	checkpointVersion = 1
+
+	def checkpoint (self, file):
+		"""Save the in-flight state of a paused network to a file.
+
+		The checkpoint holds the graph, the packets queued in every edge,
+		the groups open on them, the IIPs not sent yet, the buffers of
+		buffered inports, and the state of the components implementing
+		getState(). Packets must be picklable. The state inside subgraphs
+		is not saved.
+
+		@return: a Deferred firing with the file name.
+		"""
+
+		if not self.paused:
+			raise Error("Only a paused network can be checkpointed")
+
+		sockets = []
+		for socket, (srcKey, tgtKey) in self.connections.connections.iteritems():
+			sockets.append({
+				"src": srcKey,
+				"tgt": tgtKey,
+				"connected": socket.connected,
+				"groups": list(socket.groups),
+				"queue": list(socket.queue or ())
+			})
+
+		initials = [
+			(self.connections.connections[initial.socket][1], initial.data)
+			for initial in self.connections.initials
+		]
 
-	def stop (self):
-		# Disconnect all connections
-		for connection in self.connections:
-			if connection.connected:
-				connection.disconnect()
+		components = {}
+		buffers = {}
+
+		# Fused nodes get their state back from the fusion
+		for chain in set(self.fused.itervalues()):
+			chain.sync()
 
-		# Tell processes to shut down
 		for process in self.processes:
-			process.component.shutdown()
+			if process.component is None:
+				continue
+
+			state = process.component.getState()
+			if state is not None:
+				components[process.id] = state
+
+			for name, port in process.component.inPorts.iteritems():
+				# Events held by a full port follow the buffered ones
+				if port.buffered and (len(port.buffer) or len(port.held)):
+					buffers[process.id, name] = [_bufferedEntry(entry) for entry in list(port.buffer) + list(port.held)]
+
+		state = {
+			"version": self.checkpointVersion,
+			"graph": self.graph.toJSON(),
+			"sockets": sockets,
+			"initials": initials,
+			"defaults": [(port.node, port.name) for port in self.defaults],
+			"components": components,
+			"buffers": buffers
+		}
+
+		try:
+			data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+		except (pickle.PicklingError, TypeError) as e:
+			raise Error("Cannot checkpoint network: {:s}".format(str(e)))
+
+		atomicWrite(file, (data,))
+
+		return defer.succeed(file)
+
+	@classmethod
+	def restore (cls, file):
+		"""Rebuild a network from a checkpoint file.
+
+		N.B. Reads the file blocking.
+
+		@return: a Deferred firing with the network, paused. Queued
+			packets and pending IIPs are delivered once it is resumed.
+		"""
+
+		with open(file, "rb") as fp:
+			state = pickle.load(fp)
+
+		if state.get("version") != cls.checkpointVersion:
+			return defer.fail(Error("Unsupported checkpoint version {!r}".format(state.get("version"))))
+
+		def connected (network):
+			network.pause()
+			network._restoreState(state)
+			network.start()
+
+			return network
+
+		return cls.create(graphModule.loadJSON(state["graph"]), delayed = True) \
+			.addCallback(lambda network: network.connect()) \
+			.addCallback(connected)
+
+	def _restoreState (self, state):
+		edges = self.connections
+
+		sockets = {}
+		for socket, keys in edges.connections.iteritems():
+			sockets.setdefault(keys, deque()).append(socket)
+
+		for saved in state["sockets"]:
+			try:
+				socket = sockets[saved["src"], saved["tgt"]].popleft()
+			except (KeyError, IndexError):
+				raise Error("Checkpoint does not match the graph: no connection {!r} -> {!r}".format(saved["src"], saved["tgt"]))
+
+			socket.groups = list(saved["groups"])
+			socket.queue.extend(saved["queue"])
+
+			if saved["connected"]:
+				socket.connected = True
+				self.increaseConnections()
+
+		# IIPs already sent before the checkpoint are not sent again
+		initials = dict(
+			(edges.connections[initial.socket][1], initial.socket)
+			for initial in edges.initials
+		)
+		edges.initials = [
+			Initial(initials[tgtKey], data)
+			for tgtKey, data in state["initials"]
+			if tgtKey in initials
+		]
+
+		self.defaults = OrderedDict(
+			(self.processes.get(id).component.inPorts[name], True)
+			for id, name in state["defaults"]
+		)
+
+		# Fused nodes take their state from the components when fused again
+		fused = len(self.fused) > 0
+		self.unfuse()
+
+		for id, componentState in state["components"].iteritems():
+			self.processes.get(id).component.setState(componentState)
+
+		if fused:
+			self.fuseChains()
+
+		for (id, name), entries in state["buffers"].iteritems():
+			port = self.processes.get(id).component.inPorts[name]
+
+			for entry in entries:
+				if port.buffer.full:
+					port.held.append(entry)
+				else:
+					port.buffer.append(*entry)
+
+			if port.buffer.full and port.overflow == "block":
+				port._block()
+
+	def stop (self, drain = False, timeout = None):
+		"""Stop the network, and shut its components down in topological
+		order.
+
+		Without draining, the packets in flight are dropped and every open
+		connection is closed at once. When draining, the source processes
+		(those not fed by other processes) are cut off from the network,
+		while the packets already sent keep flowing to the sinks until the
+		network ends, or [timeout] seconds have passed.
+
+		@return: a Deferred firing with a summary dict: the number of
+			packets "drained" along edges and "dropped", and whether the
+			drain "timedOut".
+		"""
+
+		d = defer.Deferred()
+		edges = self.connections
+		summary = {
+			"drained": 0,
+			"dropped": 0,
+			"timedOut": False
+		}
+
+		# IIPs not sent yet are dropped
+		summary["dropped"] += len(edges.initials)
+		edges.initials = []
+
+		ids = [node["id"] for node in self.graph.nodes if node["id"] in self.processes.processes]
+		order, cycles = plan.sortNodes(ids, (
+			(srcKey[0], tgtKey[0])
+			for srcKey, tgtKey in edges.connections.itervalues()
+			if srcKey is not None
+		))
+
+		def discardQueues ():
+			for socket in edges:
+				if socket.queue is not None:
+					summary["dropped"] += sum(1 for event, _ in socket.queue if event == "data")
+					socket.queue.clear()
+
+		def finish ():
+			for socket in list(edges):
+				socket.close()
+				summary["dropped"] += socket.dropped
+
+			for id in order:
+				try:
+					process = self.processes.get(id)
+				except KeyError:
+					continue
+
+				if process.component is not None:
+					process.component.shutdown()
+
+			# Subgraphs share the account of the network they run in
+			if self.scheduler is not None and self.tenant is self:
+				self.scheduler.unregister(self)
+
+			d.callback(summary)
+
+		if not drain:
+			discardQueues()
+			self.resume()
+			finish()
+
+			return d
+
+		fed = set(tgtKey[0] for srcKey, tgtKey in edges.connections.itervalues() if srcKey is not None)
+		counted = []
+
+		def count (data):
+			summary["drained"] += 1
+
+		for socket, (srcKey, tgtKey) in edges.connections.iteritems():
+			socket.on("data", count)
+			counted.append(socket)
+
+			if srcKey is None or srcKey[0] not in fed:
+				socket.close()
+
+		def drained (data = None):
+			if d.called:
+				return
+
+			if call is not None and call.active():
+				call.cancel()
+
+			self.off("end", drained)
+
+			for socket in counted:
+				socket.off("data", count)
+
+			finish()
+
+		def expire ():
+			summary["timedOut"] = True
+
+			discardQueues()
+			drained()
+
+		self.on("end", drained)
+		call = None if timeout is None else reactor.callLater(timeout, expire)
+
+		# Let the packets queued by a pause flow
+		self.resume()
+
+		if not self.running:
+			drained()
+
+		return d
+
+
+def _bufferedEntry (entry):
+	# Sockets are passed along with connect and disconnect events, but
+	# they cannot be saved
+	event, payload, index = entry
+
+	if isinstance(payload, dict) and "socket" in payload:
+		payload = dict(payload)
+		del payload["socket"]
+
+	return (event, payload, index)
 
 
 class Process (object):
@@ -276,12 +919,16 @@ class Processes (EventEmitter):
 				port.node = id
 				port.nodeInstance = instance
 				port.name = name
+				port.cache = self.network.cache
 
 			if instance.subgraph:
 				self.subscribeSubgraph(process)
 
 			self.subscribeNode(process)
 
+			# Asynchronous work of the component keeps the network running
+			instance.tracker = self.network.track
+
 			self.processes[id] = process
 			d.callback(process)
 
@@ -302,6 +949,17 @@ class Processes (EventEmitter):
 		except AttributeError:
 			pass
 
+		try:
+			for port in self.processes[node].component.outPorts:
+				self.network.cache.discard(port)
+		except AttributeError:
+			pass
+
+		# A subgraph not yet subscribed may still have its own account
+		subnet = getattr(self.processes[node].component, "network", None)
+		if subnet is not None and subnet.scheduler is not None and subnet.tenant is subnet:
+			subnet.scheduler.unregister(subnet)
+
 		del self.processes[node]
 
 		return defer.succeed(True)
@@ -314,15 +972,20 @@ class Processes (EventEmitter):
 
 		process.id = newId
 
-		for port in instance.inPorts.itervalues():
-			port.node = newId
+		if process.component is not None:
+			process.component.nodeId = newId
 
-		for port in instance.outPorts.itervalues():
-			port.node = newId
+			for port in process.component.inPorts:
+				port.node = newId
+
+			for port in process.component.outPorts:
+				port.node = newId
 
 		self.processes[newId] = process
 		del self.processes[oldId]
 
+		self.network.connections.renameNode(oldId, newId)
+
 		return defer.succeed(True)
 
 	def subscribeSubgraph (self, node):
@@ -333,29 +996,34 @@ class Processes (EventEmitter):
 
 			return
 
-		if not hasattr(node.component, "network"):
+		if getattr(node.component, "network", None) is None:
+			return
+
+		subnet = node.component.network
+
+		if subnet is None:
 			return
 
+		subnet.scheduler = self.network.scheduler
+		subnet.tenant = self.network.tenant
+
+		# A running subgraph counts as one open connection of its parent
+		subnet.on("start", lambda data: self.network.increaseConnections())
+		subnet.on("end", lambda data: self.network.decreaseConnections())
+
 		def subscribeSubgraphHandler (event, data = None):
-			if event == "connect":
-				self.network.increaseConnections()
-			elif event == "disconnect":
-				self.network.increaseConnections()
-			elif event not in ("data", "begingroup", "endgroup"):
-				return
-			
 			if data is None:
 				data = {}
 
 			if "subgraph" in data:
-				data["subgraph"].insert(node.id, 0)
+				data["subgraph"].insert(0, node.id)
 			else:
 				data["subgraph"] = [node.id]
 
-			self.emit(event, **data)
+			self.network.emit(event, **data)
 
 		for event in ('connect', 'begingroup', 'data', 'endgroup', 'disconnect'):
-			node.component.network.on(
+			subnet.on(
 				event, 
 				functools.partial(subscribeSubgraphHandler, event)
 			)
@@ -392,15 +1060,114 @@ class Initial (object):
 		self.data = data
 
 
+def _key (endpoint):
+	return (endpoint["node"], endpoint["port"], endpoint.get("index"))
+
+def _matches (key, pattern):
+	# A pattern without an index matches every index of its port
+	if key is None:
+		return False
+
+	return key[:2] == pattern[:2] and (pattern[2] is None or key[2] == pattern[2])
+
+
 class Edges (object):
 	def __init__ (self, network):
 		self.initials = []
-		self.connections = []
 		self.network = network
 
+		# socket: (src key, tgt key), keys being (node, port, index) tuples
+		self.connections = OrderedDict()
+		self.bySrc = {}
+		self.byTgt = {}
+
 	def __iter__ (self):
 		return iter(self.connections)
 
+	def __len__ (self):
+		return len(self.connections)
+
+	def _index (self, socket, src, tgt):
+		srcKey = None if src is None else _key(src)
+		tgtKey = _key(tgt)
+
+		self.connections[socket] = (srcKey, tgtKey)
+
+		if srcKey is not None:
+			self.bySrc.setdefault(srcKey, OrderedDict())[socket] = True
+
+		self.byTgt.setdefault(tgtKey, OrderedDict())[socket] = True
+		socket.gate = self.network.gate
+
+		if self.network.paused:
+			socket.pause()
+
+	def _unindex (self, socket):
+		srcKey, tgtKey = self.connections.pop(socket)
+		self.network.untraceSocket(socket, force = True)
+		socket.gate = None
+
+		for table, key in ((self.bySrc, srcKey), (self.byTgt, tgtKey)):
+			if key is None:
+				continue
+
+			sockets = table[key]
+			del sockets[socket]
+
+			if not len(sockets):
+				del table[key]
+
+	def find (self, src, tgt):
+		"""The sockets connecting the src endpoint to the tgt endpoint.
+		Endpoints are dicts of node, port and optional index; without an
+		index, they match every index of their port."""
+
+		srcKey = _key(src)
+		tgtKey = _key(tgt)
+
+		if tgtKey[2] is not None:
+			sockets = self.byTgt.get(tgtKey, ())
+		else:
+			try:
+				port = self.network.processes.get(tgtKey[0]).component.inPorts[tgtKey[1]]
+			except (KeyError, AttributeError):
+				return []
+
+			sockets = [socket for socket in port.sockets.itervalues() if socket in self.connections]
+
+		return [
+			socket for socket in sockets
+			if _matches(self.connections[socket][0], srcKey)
+		]
+
+	def renameNode (self, oldId, newId):
+		rename = lambda key: key if key is None or key[0] != oldId else (newId,) + key[1:]
+
+		def move (table, key, newKey, socket):
+			sockets = table[key]
+			del sockets[socket]
+
+			if not len(sockets):
+				del table[key]
+
+			table.setdefault(newKey, OrderedDict())[socket] = True
+
+		for socket, (srcKey, tgtKey) in self.connections.iteritems():
+			newSrcKey = rename(srcKey)
+			newTgtKey = rename(tgtKey)
+
+			if newSrcKey is srcKey and newTgtKey is tgtKey:
+				continue
+
+			if newSrcKey is not srcKey:
+				move(self.bySrc, srcKey, newSrcKey, socket)
+
+			if newTgtKey is not tgtKey:
+				move(self.byTgt, tgtKey, newTgtKey, socket)
+
+			self.connections[socket] = (newSrcKey, newTgtKey)
+			socket.resetId()
+
 	def add (self, src, tgt, metadata = None):
 		socket = InternalSocket()
 
@@ -418,7 +1185,7 @@ class Edges (object):
 
 			@fromNode.component.once("ready")
 			def addEdge (data):
-				self.add(src, target, metadata).addCallbacks(d.callback, d.errback)
+				self.add(src, tgt, metadata).addCallbacks(d.callback, d.errback)
 
 			return d
 
@@ -436,7 +1203,7 @@ class Edges (object):
 
 			@toNode.component.once("ready")
 			def addEdge (data):
-				self.add(src, target, metadata).addCallbacks(d.callback, d.errback)
+				self.add(src, tgt, metadata).addCallbacks(d.callback, d.errback)
 
 			return d
 
@@ -446,32 +1213,29 @@ class Edges (object):
 
 		self.network.subscribeSocket(socket)
 
-		self.connections.append(socket)
+		self._index(socket, src, tgt)
+
+		# New connections get the last packets of caching ports at once
+		fromNode.component.outPorts[src["port"]].replayCache(socket, src["index"])
 
 		return defer.succeed(None)
 
 	def remove (self, src, tgt):
-		for connection in self.connections[:]:
-			if tgt["node"] == connection.tgt["process"].id \
-			and tgt["port"] == connection.tgt["port"]:
-				connection.tgt["process"].component.inPorts[connection.tgt["port"]].detach(connection)
-
-			if connection.src is not None \
-			and "node" in src \
-			and src["node"] is not None:
-				if connection.tgt and src["node"] == connection.src["process"].id \
-				and src["port"] == connection.src["port"]:
-					connection.src["process"].component.outPorts[connection.src["port"]].detach(connection)
-
-			self.connections.remove(connection)
-			return defer.succeed(None)
+		for connection in self.find(src, tgt):
+			connection.tgt["process"].component.inPorts[connection.tgt["port"]].detach(connection)
+			connection.src["process"].component.outPorts[connection.src["port"]].detach(connection)
+
+			self._unindex(connection)
+
+		return defer.succeed(None)
 		
-	def addInitial (self, src, tgt, metadata = None):
-		socket = InternalSocket()
-		d = defer.Deferred()
+	def addInput (self, tgt):
+		"""Attach a socket with no source process to an inport.
 
-		# Subscribe to events from the socket
-		self.network.subscribeSocket(socket)
+		@return: a Deferred firing with the socket.
+		"""
+
+		socket = InternalSocket()
 
 		try:
 			to = self.network.processes.get(tgt["node"])
@@ -482,24 +1246,37 @@ class Edges (object):
 			d = defer.Deferred()
 
 			@to.component.once("ready")
-			def addInitial (data):
-				self.addInitial(src, target, metadata).addCallbacks(d.callback, d.errback)
+			def addInput (data):
+				self.addInput(tgt).addCallbacks(d.callback, d.errback)
 
 			return d
 
-		self.network.connectPort(socket, to, tgt["port"], tgt["index"], True)
+		self.network.connectPort(socket, to, tgt["port"], tgt.get("index"), True)
 
-		self.connections.append(socket)
-		self.initials.append(Initial(socket, src["data"]))
+		# Subscribe to events from the socket, after the inport so that the
+		# connection is only closed once the component reacted to it
+		self.network.subscribeSocket(socket)
 
-		return defer.succeed(None)
+		self._index(socket, None, tgt)
+
+		return defer.succeed(socket)
+
+	def addInitial (self, src, tgt, metadata = None):
+		def added (socket):
+			self.initials.append(Initial(socket, src["data"]))
+
+		return self.addInput(tgt).addCallback(added)
 
 	def removeInitial (self, tgt):
-		for connection in self.connections:
-			if tgt["node"] == connection.tgt["process"].id \
-			and tgt["port"] == connection.tgt["port"]:
-				connection.tgt["process"].component.inPorts[connection.tgt["port"]].detach(connection)
-				self.connections.remove(connection)
+		for connection in list(self.byTgt.get(_key(tgt), ())):
+			if self.connections[connection][0] is not None:
+				continue
+
+			connection.tgt["process"].component.inPorts[connection.tgt["port"]].detach(connection)
+			self._unindex(connection)
+
+			if len(self.initials):
+				self.initials = [i for i in self.initials if i.socket is not connection]
 
 		return defer.succeed(None)
 
@@ -513,8 +1290,11 @@ class Edges (object):
 	def sendInitials (self):
 		d = defer.Deferred()
 
+		# Default values of inports go first, in the same pass
 		def send ():
 			try:
+				self.network.sendDefaults()
+
 				for initial in self.initials:
 					self.sendInitial(initial)
 
@@ -523,8 +1303,11 @@ class Edges (object):
 			except:
 				f = failure.Failure()
 				d.errback(f)
+			finally:
+				self.network.release()
 
-		reactor.callLater(0, send)
+		self.network.hold()
+		self.network.callSoon(send)
 		return d
 
 class Error (Exception):
@@ -0,0 +1,353 @@
+from twisted.python import log
+
+from collections import namedtuple, OrderedDict
+
+import hashlib
+import json
+
+# An execution plan is the result of checking a Graph against the component
+# registry once, ahead of wiring.  It is immutable, and cached by the hash
+# of the graph structure so that running the same graph again skips the
+# compilation step entirely.
+
+Endpoint = namedtuple("Endpoint", ("node", "port", "index"))
+Connection = namedtuple("Connection", ("src", "tgt", "metadata"))
+Initial = namedtuple("Initial", ("data", "tgt", "metadata"))
+
+
+# Datatypes which may be connected to a port of a different datatype.
+# Other mismatches are only warned about, as many components cast what they
+# receive (strings to numbers, numbers to ints, etc).
+_widening = {
+	("int", "number"),
+	("color", "string"),
+}
+
+def compatible (srcType, tgtType):
+	"""Whether packets of srcType are always fit for a port of tgtType"""
+
+	if srcType == tgtType:
+		return True
+
+	# 'all' ports send and accept anything, and 'bang' ports only care
+	# about the arrival of a packet, not its contents
+	if "all" in (srcType, tgtType) or tgtType == "bang":
+		return True
+
+	return (srcType, tgtType) in _widening
+
+
+def graphHash (graph):
+	"""A hash of the structure of a graph.
+
+	Node metadata (positions, labels, etc) is left out, so moving nodes
+	around in the UI does not invalidate compiled plans. Edge and IIP
+	metadata is part of the plan, and of the hash."""
+
+	structure = {
+		"nodes": [(node["id"], node["component"]) for node in graph.nodes],
+		"edges": [
+			(
+				(edge["src"]["node"], edge["src"]["port"], edge["src"]["index"]),
+				(edge["tgt"]["node"], edge["tgt"]["port"], edge["tgt"]["index"]),
+				edge.get("metadata")
+			)
+			for edge in graph.edges
+		],
+		"initials": [
+			(
+				initial["src"]["data"],
+				(initial["tgt"]["node"], initial["tgt"]["port"], initial["tgt"]["index"]),
+				initial.get("metadata")
+			)
+			for initial in graph.initials
+		]
+	}
+
+	return hashlib.sha1(json.dumps(structure, sort_keys = True, default = repr)).hexdigest()
+
+
+class FrozenDict (OrderedDict):
+	""" An ordered dict which can't be changed once built. """
+
+	def __init__ (self, *args, **kwargs):
+		OrderedDict.__init__(self, *args, **kwargs)
+		self._frozen = True
+
+	def __setitem__ (self, key, value, *args):
+		if getattr(self, "_frozen", False):
+			raise TypeError("Execution plans can't be changed")
+
+		OrderedDict.__setitem__(self, key, value, *args)
+
+	def _readOnly (self, *args, **kwargs):
+		raise TypeError("Execution plans can't be changed")
+
+	__delitem__ = clear = pop = popitem = setdefault = update = _readOnly
+
+
+class ExecutionPlan (object):
+	"""All the tables of a plan are read-only (see L{FrozenDict}), except for
+	the packets of IIPs, which are shared with the graph.
+
+	@type hash: C{str}
+	@ivar hash: Hash of the graph structure the plan was compiled from.
+
+	@type components: L{FrozenDict}
+	@ivar components: Node id to fully qualified component name.
+
+	@type order: C{tuple}
+	@ivar order: Node ids in topological order. Nodes which are part of a
+		cycle are kept together, in graph order.
+
+	@type cycles: C{tuple}
+	@ivar cycles: Tuples of node ids forming a cycle.
+
+	@type fanout: L{FrozenDict}
+	@ivar fanout: (node, port) of every connected outport to the tuple of
+		L{Connection}s leaving it.
+
+	@type initials: C{tuple}
+	@ivar initials: L{Initial}s in graph order.
+	"""
+
+	__slots__ = ("hash", "registry", "components", "order", "cycles", "fanout", "initials")
+
+	def __init__ (self, hash, registry, components, order, cycles, fanout, initials):
+		self.hash = hash
+		self.registry = registry
+		self.components = components
+		self.order = order
+		self.cycles = cycles
+		self.fanout = fanout
+		self.initials = initials
+
+	@property
+	def acyclic (self):
+		return len(self.cycles) == 0
+
+	def connections (self):
+		""" Iterates connections, grouped by source node in topological order. """
+
+		for connections in self.fanout.itervalues():
+			for connection in connections:
+				yield connection
+
+
+def sortNodes (nodes, edges):
+	"""Order nodes topologically, and find the cycles between them
+
+	@type nodes: C{list}
+	@param nodes: Node ids, in graph order.
+
+	@type edges: C{list}
+	@param edges: (src node, tgt node) tuples.
+
+	@return: (order, cycles) tuple.
+	"""
+
+	successors = OrderedDict((node, []) for node in nodes)
+	for src, tgt in edges:
+		if src in successors and tgt in successors:
+			successors[src].append(tgt)
+
+	# Iterative Tarjan, so that long chains don't hit the recursion limit.
+	# Strongly connected components come out in reverse topological order;
+	# visiting the roots backwards keeps unrelated nodes in graph order.
+	index = {}
+	lowlink = {}
+	stack = []
+	onStack = set()
+	components = []
+
+	for root in reversed(successors):
+		if root in index:
+			continue
+
+		work = [(root, 0)]
+
+		while len(work):
+			node, i = work.pop()
+
+			if i == 0:
+				index[node] = lowlink[node] = len(index)
+				stack.append(node)
+				onStack.add(node)
+
+			for j in xrange(i, len(successors[node])):
+				successor = successors[node][j]
+
+				if successor not in index:
+					work.append((node, j + 1))
+					work.append((successor, 0))
+					break
+				elif successor in onStack:
+					lowlink[node] = min(lowlink[node], index[successor])
+			else:
+				if lowlink[node] == index[node]:
+					component = []
+
+					while True:
+						member = stack.pop()
+						onStack.discard(member)
+						component.append(member)
+
+						if member == node:
+							break
+
+					components.append(component)
+
+				if len(work):
+					parent = work[-1][0]
+					lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+	position = dict((node, i) for i, node in enumerate(nodes))
+	order = []
+	cycles = []
+
+	for component in reversed(components):
+		component.sort(key = position.get)
+		order.extend(component)
+
+		if len(component) > 1 or component[0] in successors[component[0]]:
+			cycles.append(tuple(component))
+
+	return tuple(order), tuple(cycles)
+
+
+def _metadata (edge):
+	# Plans are shared, and must not change along with the graph
+	metadata = edge.get("metadata")
+	return FrozenDict(metadata) if metadata is not None else None
+
+
+def compile (graph, loader, hash = None):
+	"""Compile a graph into an L{ExecutionPlan}.
+
+	The component loader must have listed its components already.
+
+	Connections between ports of datatypes which aren't L{compatible} are
+	logged, but still made.
+
+	@raise Error: when a component or port does not exist.
+	"""
+
+	nodes = []
+	components = {}
+	details = {}
+	ports = {}
+
+	for node in graph.nodes:
+		try:
+			name, cached = loader.resolve(node["component"])
+		except KeyError:
+			raise Error("Component {:s} not available for node {:s}".format(node["component"], node["id"]))
+
+		nodes.append(node["id"])
+		components[node["id"]] = name
+		details[node["id"]] = cached.details
+
+	def port (endpoint, direction):
+		try:
+			info = details[endpoint["node"]]
+		except KeyError:
+			raise Error("No process defined for node {:s}".format(endpoint["node"]))
+
+		# Subgraph ports depend on the graph they are given, so they can
+		# only be checked once the network is wired
+		if info["subgraph"]:
+			return None
+
+		try:
+			table = ports[endpoint["node"], direction]
+		except KeyError:
+			table = ports[endpoint["node"], direction] = dict(
+				(port["id"], port) for port in info[direction]
+			)
+
+		try:
+			return table[endpoint["port"]]
+		except KeyError:
+			raise Error("No {:s} '{:s}' defined in process {:s}".format(
+				"inport" if direction == "inPorts" else "outport",
+				endpoint["port"],
+				endpoint["node"]
+			))
+
+	fanout = OrderedDict()
+
+	for edge in graph.edges:
+		srcPort = port(edge["src"], "outPorts")
+		tgtPort = port(edge["tgt"], "inPorts")
+
+		if srcPort is not None and tgtPort is not None \
+		and not compatible(srcPort["type"], tgtPort["type"]):
+			log.msg("Connecting {:s} {:s} ({:s}) to {:s} {:s} ({:s})".format(
+				edge["src"]["node"], edge["src"]["port"].upper(), srcPort["type"],
+				edge["tgt"]["node"], edge["tgt"]["port"].upper(), tgtPort["type"]
+			))
+
+		src = Endpoint(edge["src"]["node"], edge["src"]["port"], edge["src"]["index"])
+		tgt = Endpoint(edge["tgt"]["node"], edge["tgt"]["port"], edge["tgt"]["index"])
+		fanout.setdefault((src.node, src.port), []).append(Connection(src, tgt, _metadata(edge)))
+
+	initials = []
+
+	for initial in graph.initials:
+		port(initial["tgt"], "inPorts")
+
+		tgt = Endpoint(initial["tgt"]["node"], initial["tgt"]["port"], initial["tgt"]["index"])
+		initials.append(Initial(initial["src"]["data"], tgt, _metadata(initial)))
+
+	order, cycles = sortNodes(nodes, (
+		(src, connection.tgt.node)
+		for (src, _), connections in fanout.iteritems()
+		for connection in connections
+	))
+
+	# Freeze the routing tables in topological order of their source nodes
+	position = dict((node, i) for i, node in enumerate(order))
+	routes = FrozenDict(
+		(key, tuple(fanout[key]))
+		for key in sorted(fanout, key = lambda key: position[key[0]])
+	)
+
+	return ExecutionPlan(
+		hash or graphHash(graph),
+		loader.token,
+		FrozenDict(components),
+		order,
+		cycles,
+		routes,
+		tuple(initials)
+	)
+
+
+cacheSize = 32
+_cache = OrderedDict()
+
+def getPlan (graph, loader):
+	"""Return the L{ExecutionPlan} for a graph, compiling it if necessary"""
+
+	key = graphHash(graph)
+
+	try:
+		plan = _cache.pop(key)
+	except KeyError:
+		pass
+	else:
+		if plan.registry == loader.token:
+			_cache[key] = plan
+			return plan
+
+	plan = compile(graph, loader, key)
+	_cache[key] = plan
+
+	while len(_cache) > cacheSize:
+		_cache.popitem(last = False)
+
+	return plan
+
+
+class Error (Exception):
+	pass
@@ -1,9 +1,14 @@
-from twisted.internet import reactor, defer
+from twisted.internet import defer
 
+import copy
 import functools
-from collections import OrderedDict
+import heapq
+import sys
+import types
+from collections import deque, OrderedDict
 
 from util import EventEmitter
+import validation
 
 validTypes = [
   'all',
@@ -20,6 +25,299 @@ validTypes = [
   'buffer'
 ]
 
+# Packets of these types are never copied on fan-out
+_immutable = frozenset((
+	types.NoneType, bool, int, long, float, complex, str, unicode, frozenset
+))
+
+
+class RingBuffer (object):
+	"""FIFO of (event, payload, index) entries in a preallocated ring of
+	slots, keeping a running count of the entries of each event.
+
+	With a capacity, appending to a full buffer raises L{Error}. Without
+	one, the ring doubles in size when it fills up.
+	"""
+
+	__slots__ = ("slots", "head", "size", "capacity", "counts")
+
+	def __init__ (self, capacity = None):
+		if capacity is not None and capacity < 1:
+			raise Error("Buffer capacity must be positive")
+
+		self.capacity = capacity
+		self.slots = [None] * (capacity or 16)
+		self.head = 0
+		self.size = 0
+		self.counts = {}
+
+	def __len__ (self):
+		return self.size
+
+	def __iter__ (self):
+		slots = self.slots
+		for i in xrange(self.size):
+			yield slots[(self.head + i) % len(slots)]
+
+	@property
+	def full (self):
+		return self.size == self.capacity
+
+	def count (self, event):
+		return self.counts.get(event, 0)
+
+	def append (self, event, payload, index = None):
+		slots = self.slots
+
+		if self.size == len(slots):
+			if self.capacity is not None:
+				raise Error("Buffer full")
+
+			slots = self.slots = list(self) + [None] * len(slots)
+			self.head = 0
+
+		slots[(self.head + self.size) % len(slots)] = (event, payload, index)
+		self.size += 1
+		self.counts[event] = self.counts.get(event, 0) + 1
+
+	def popleft (self):
+		if not self.size:
+			raise IndexError("pop from an empty buffer")
+
+		entry = self.slots[self.head]
+
+		# Don't keep packets alive once they were received
+		self.slots[self.head] = None
+		self.head = (self.head + 1) % len(self.slots)
+		self.size -= 1
+		self.counts[entry[0]] -= 1
+
+		return entry
+
+	def discard (self, event):
+		"""Remove the oldest entry of [event], moving the entries before it
+		up one slot.
+
+		@return: the entry, or None if there is none.
+		"""
+
+		slots = self.slots
+		length = len(slots)
+
+		for i in xrange(self.size):
+			if slots[(self.head + i) % length][0] == event:
+				return self._remove(i)
+
+		return None
+
+	def discardPairs (self, opening, closing):
+		""" Remove every [opening] entry directly followed by [closing]. """
+
+		slots = self.slots
+		i = 0
+
+		while i < self.size - 1:
+			length = len(slots)
+
+			if slots[(self.head + i) % length][0] == opening and slots[(self.head + i + 1) % length][0] == closing:
+				self._remove(i + 1)
+				self._remove(i)
+				i = max(i - 1, 0)
+			else:
+				i += 1
+
+	def _remove (self, i):
+		slots = self.slots
+		length = len(slots)
+		entry = slots[(self.head + i) % length]
+
+		for j in xrange(i, 0, -1):
+			slots[(self.head + j) % length] = slots[(self.head + j - 1) % length]
+
+		slots[self.head] = None
+		self.head = (self.head + 1) % length
+		self.size -= 1
+		self.counts[entry[0]] -= 1
+
+		return entry
+
+	def clear (self):
+		self.slots = [None] * len(self.slots)
+		self.head = 0
+		self.size = 0
+		self.counts = {}
+
+
+def sizeOf (data, _seen = None):
+	""" Approximate memory used by a packet, in bytes. """
+
+	if _seen is None:
+		_seen = set()
+
+	if id(data) in _seen:
+		return 0
+
+	_seen.add(id(data))
+	size = sys.getsizeof(data)
+
+	if isinstance(data, dict):
+		for key, value in data.iteritems():
+			size += sizeOf(key, _seen) + sizeOf(value, _seen)
+	elif isinstance(data, (list, tuple, set, frozenset, deque)):
+		for item in data:
+			size += sizeOf(item, _seen)
+
+	return size
+
+
+class PortCache (object):
+	"""The last packets sent by caching outports, shared by the ports of a
+	network so that its memory use is bounded as a whole. When more than
+	[maxBytes] are cached, the least recently updated entries go first.
+
+	Entries are kept per port and socket index, each holding up to the
+	number of packets the port caches.
+	"""
+
+	def __init__ (self, maxBytes = None):
+		self.maxBytes = maxBytes
+		self.bytes = 0
+		self.evictions = 0
+
+		# (port, index): [deque of (packet, size), total size]
+		self.entries = OrderedDict()
+
+	def __len__ (self):
+		return len(self.entries)
+
+	def store (self, port, index, data, depth = 1, limit = None):
+		key = (port, index)
+		size = sizeOf(data)
+
+		try:
+			entry = self.entries.pop(key)
+		except KeyError:
+			entry = [deque(), 0]
+
+		packets = entry[0]
+		packets.append((data, size))
+		entry[1] += size
+		self.bytes += size
+
+		while len(packets) > depth or (limit is not None and entry[1] > limit and len(packets)):
+			_, dropped = packets.popleft()
+			entry[1] -= dropped
+			self.bytes -= dropped
+
+		if len(packets):
+			self.entries[key] = entry
+
+		while self.maxBytes is not None and self.bytes > self.maxBytes and len(self.entries):
+			# Only this entry is left: keep its most recent packets
+			if len(self.entries) == 1 and len(packets) > 1:
+				_, dropped = packets.popleft()
+				entry[1] -= dropped
+				self.bytes -= dropped
+				continue
+
+			_, (_, evicted) = self.entries.popitem(last = False)
+			self.bytes -= evicted
+			self.evictions += 1
+
+	def get (self, port, index):
+		""" The cached packets of a port index, oldest first. """
+
+		try:
+			return [data for data, size in self.entries[port, index][0]]
+		except KeyError:
+			return []
+
+	def discard (self, port):
+		for key in [key for key in self.entries if key[0] is port]:
+			_, size = self.entries.pop(key)
+			self.bytes -= size
+
+
+class Substream (object):
+	"""A complete bracketed group of packets: the packets and substreams
+	sent between a begingroup and its matching endgroup."""
+
+	def __init__ (self, group, items = None):
+		self.group = group
+		self.items = [] if items is None else items
+
+	def __iter__ (self):
+		return iter(self.items)
+
+	def __len__ (self):
+		return len(self.items)
+
+	def __repr__ (self):
+		return "Substream({!r}, {!r})".format(self.group, self.items)
+
+	def events (self):
+		""" The substream as (event, value) socket events. """
+
+		stack = [iter((self,))]
+
+		while len(stack):
+			for item in stack[-1]:
+				if isinstance(item, Substream):
+					yield ("begingroup", item.group)
+					stack.append(iter(item.items))
+					break
+
+				yield ("data", item)
+			else:
+				stack.pop()
+
+				if len(stack):
+					yield ("endgroup", None)
+
+
+class SubstreamAssembler (object):
+	"""Collects the events from one socket into substreams for an inport
+	in substream mode. Packets outside of any group are delivered as
+	usual."""
+
+	def __init__ (self, port, index):
+		self.port = port
+		self.index = index
+		self.stack = []
+
+	def handle (self, event, data):
+		stack = self.stack
+
+		if event == "data":
+			if len(stack):
+				stack[-1].items.append(data["data"])
+			else:
+				self.port.handleSocketEvent("data", data, self.index)
+
+			return
+
+		if event == "begingroup":
+			stack.append(Substream(data["group"]))
+			return
+
+		if event == "endgroup":
+			if not len(stack):
+				return
+
+			substream = stack.pop()
+		else:
+			substream = data["substream"]
+
+		if len(stack):
+			stack[-1].items.append(substream)
+		else:
+			self.port.handleSocketEvent("substream", { "substream": substream }, self.index)
+
+	def reset (self, data = None):
+		# Groups left open by a disconnect are discarded
+		self.stack = []
+
+
 class Port (EventEmitter):
 	name = None
 	node = None
@@ -41,7 +339,14 @@ class Port (EventEmitter):
 		options["required"] = required
 
 		self.options = options
+
+		# index: socket, and the other way round
 		self.sockets = {}
+		self.indexes = {}
+
+		# Indices freed by detaching, lowest first, and the next one never used
+		self.free = []
+		self.nextIndex = 0
 		self.node = None
 		self.name = None
 
@@ -70,18 +375,27 @@ class Port (EventEmitter):
 	@property
 	def buffered (self):
 		return "buffered" in self.options and self.options["buffered"]
+
+	@property
+	def substream (self):
+		return self.options.get("substream", False)
 	
 	@property
 	def required (self):
 		return self.options["required"]
 	
 	def attach (self, socket, index = None):
-		if not self.addressable or index is None:
-			index = len(self.sockets)
+		# Attaching a socket twice has no effect
+		if socket in self.indexes:
+			return
 
-		# What is the action if socket is already in sockets?
+		if not self.addressable or index is None:
+			index = self._allocate()
+		elif index in self.sockets:
+			self.detach(self.sockets[index])
 
 		self.sockets[index] = socket
+		self.indexes[socket] = index
 
 		self.attachSocket(socket, index)
 
@@ -90,21 +404,46 @@ class Port (EventEmitter):
 
 		self.emit("attach", socket = socket, index = index)
 
+	def _allocate (self):
+		# Reuse the lowest free index, if any. Indices taken explicitly
+		# since they were freed are skipped.
+		free = self.free
+
+		while len(free):
+			index = heapq.heappop(free)
+
+			if index not in self.sockets:
+				return index
+
+		while self.nextIndex in self.sockets:
+			self.nextIndex += 1
+
+		index = self.nextIndex
+		self.nextIndex += 1
+
+		return index
+
 	def attachSocket (self, socket, index):
 		pass
 
 	def detach (self, socket):
 		try:
-			index = next(k for k, v in self.sockets.iteritems() if v == socket)
-		except StopIteration:
+			index = self.indexes.pop(socket)
+		except KeyError:
 			return
 
 		del self.sockets[index]
+		heapq.heappush(self.free, index)
+
+		self.detachSocket(socket, index)
 
 		if not self.addressable:
 			index = None
 
 		self.emit("detach", socket = socket, index = index)
+
+	def detachSocket (self, socket, index):
+		pass
 		
 	@property
 	def attached (self, index = None):
@@ -131,6 +470,16 @@ class Port (EventEmitter):
 
 
 class InPort (Port):
+	# What a buffered inport with a capacity does with a packet arriving
+	# when it is full: pause the sockets feeding it until packets are
+	# received, drop the oldest packet, or raise an error. Brackets are
+	# never dropped; when dropping, they don't count against the capacity
+	# either, so that there is always a packet to drop.
+	overflowPolicies = ("block", "drop-oldest", "error")
+
+	# Set by the network when it validates the packets of the port
+	validator = None
+
 	def __init__ (self, process = None, **options):
 		if "buffered" not in options:
 			options["buffered"] = False
@@ -142,40 +491,91 @@ class InPort (Port):
 
 		Port.__init__(self, **options)
 
-		reactor.callLater(0, self.sendDefault)
-
 		if self.buffered:
-			self.buffer = deque()
+			if self.overflow not in self.overflowPolicies:
+				raise Error("Invalid overflow policy {:s} specified".format(self.overflow))
+
+			if self.overflow == "drop-oldest":
+				if self.capacity is not None and self.capacity < 1:
+					raise Error("Buffer capacity must be positive")
+
+				self.buffer = RingBuffer()
+			else:
+				self.buffer = RingBuffer(self.capacity)
+			self.blocked = []
+			self.held = deque()
+			self.dropped = 0
+
+	@property
+	def capacity (self):
+		return self.options.get("capacity")
+
+	@property
+	def overflow (self):
+		return self.options.get("overflow", "block")
+
+	def detach (self, socket):
+		Port.detach(self, socket)
+
+		if self.buffered and socket in self.blocked:
+			self.blocked.remove(socket)
+			socket.resume()
 
 	def attachSocket (self, socket, index = None):
 		handle = self.handleSocketEvent
 
+		# Sockets attached to a blocked port wait with the others
+		if self.buffered and self.overflow == "block" and (self.buffer.full or len(self.held)):
+			socket.pause()
+			self.blocked.append(socket)
+
 		for e in ("connect", "disconnect"):
 			socket.on(e, functools.partial(handle, e, socket = socket, index = index))
 
+		# In substream mode, whole groups arrive as one 'substream' event
+		if self.substream:
+			assembler = SubstreamAssembler(self, index)
+			socket.substreams = True
+			socket.on("disconnect", assembler.reset)
+
+			for e in ("begingroup", "data", "endgroup", "substream"):
+				socket.on(e, functools.partial(assembler.handle, e))
+
+			return
+
 		for e in ("begingroup", "data", "endgroup"):
-			socket.on(e, functools.partial(handle, e, index = index))
+			socket.on(e, functools.partial(handle, e, socket = socket, index = index))
+
+	def detachSocket (self, socket, index):
+		# The next inport the socket is attached to may not take substreams
+		socket.substreams = False
 
 	def handleSocketEvent (self, event, data, index = None, socket = None):
+		# Invalid packets are dropped when the network validates strictly
+		if event == "data" and self.validator is not None and not self.validator(data["data"]):
+			return
+
 		if self.buffered:
-			self.buffer.append({
-				"event": event,
-				"payload": data,
-				"index": index
-			})
+			if self.overflow == "drop-oldest":
+				if event == "data" and self.capacity is not None and self.buffer.count("data") >= self.capacity:
+					self.buffer.discard("data")
+					self.dropped += 1
 
-			if self.addressable:
-				if self.process is not None:
-					self.process(event, index)
+					# Connections and groups emptied by dropping go too
+					self.buffer.discardPairs("begingroup", "endgroup")
+					self.buffer.discardPairs("connect", "disconnect")
 
-				self.emit(event, index = index)
-			else:
-				if self.process is not None:
-					self.process(event)
+			elif self.buffer.full or (len(self.held) and self.overflow == "block"):
+				if self.overflow == "block":
+					# Held until packets are received, behind the events held
+					# before; the sender queues the next ones itself
+					self.held.append((event, data, index))
+					self._block()
+					return
 
-				self.emit(event)
+				raise Error("{:s}: Buffer full".format(self.id))
 
-			return
+			return self._store(event, data, index)
 
 		# Call the processing function	
 		if self.process is not None:
@@ -190,44 +590,181 @@ class InPort (Port):
 		else:
 			self.emit(event, nodeInstance = self.nodeInstance, **data)
 
-	def sendDefault (self):
+	@property
+	def hasDefault (self):
+		return "default" in self.options
+
+	def sendDefault (self, socket = None):
+		"""Deliver the default value of the port to each of its sockets, or
+		to [socket] only if it is still attached. Networks call this when
+		they start, and when they wire the port later on."""
+
 		if "default" not in self.options:
 			return
 
-		for index, socket in self.sockets.iteritems():
-			self.handleSocketEvent("data", self.options["default"], index)
+		if socket is None:
+			indexes = list(self.sockets)
+		elif socket in self.indexes:
+			indexes = [self.indexes[socket]]
+		else:
+			return
+
+		for index in indexes:
+			self.handleSocketEvent("data", { "data": self.options["default"] }, index)
 
 	def validateData (self, data):
-		return "values" not in self.options or data in self.options["values"]
+		""" Whether a packet matches the declarations of the port. """
+		check = validation.compile(self)
+		return check is None or check(data) is None
+
+	def _store (self, event, data, index):
+		self.buffer.append(event, data, index)
+
+		if self.buffer.full and self.overflow == "block":
+			self._block()
+
+		if self.addressable:
+			if self.process is not None:
+				self.process(event, index)
+
+			self.emit(event, index = index)
+		else:
+			if self.process is not None:
+				self.process(event)
+
+			self.emit(event)
+
+	def _block (self):
+		for socket in self.sockets.itervalues():
+			if socket not in self.blocked:
+				socket.pause()
+				self.blocked.append(socket)
+
+	def _unblock (self):
+		if not (len(self.blocked) or len(self.held)) or self.buffer.full:
+			return
+
+		# Held events go first, in the order they arrived
+		held = self.held
+		while len(held) and not self.buffer.full:
+			self._store(*held.popleft())
+
+		if len(held) or self.buffer.full:
+			return
+
+		# Resuming delivers what the sockets queued, which may fill the
+		# buffer and block them again
+		blocked = self.blocked
+		self.blocked = []
+
+		for socket in blocked:
+			socket.resume()
+
+	def _entry (self, entry):
+		event, payload, index = entry
+
+		return {
+			"event": event,
+			"payload": payload,
+			"index": index
+		}
 
 	def receive (self):
 		""" Returns the next packet in the buffer. """
 		try:
-			return self.buffer.popleft()
+			entry = self.buffer.popleft()
 		except IndexError:
 			return None
 		except AttributeError:
 			raise Error('Receive is only possible on buffered ports')
 
+		self._unblock()
+
+		return self._entry(entry)
+
+	def receiveMany (self, n):
+		""" Returns up to [n] packets from the buffer. """
+		try:
+			buffer = self.buffer
+		except AttributeError:
+			raise Error('Receive is only possible on buffered ports')
+
+		entries = [buffer.popleft() for _ in xrange(min(n, len(buffer)))]
+
+		self._unblock()
+
+		return [self._entry(entry) for entry in entries]
+
 	@property
 	def contains (self):
 		""" The number of data packets in a buffered inport. """
 		try:
-			return len(p for p in self.buffer if p["event"] == "data")
+			return self.buffer.count("data")
 		except AttributeError:
 			raise Error('Contains query is only possible on buffered ports')
 
 
 class OutPort (Port):
+	# How a packet is handed to the sockets of a port when there are several:
+	# the same object to all of them, which must then treat it as read-only,
+	# or a (deep) copy to each one but the last.
+	fanoutPolicies = {
+		"share": None,
+		"copy": copy.copy,
+		"deepcopy": copy.deepcopy
+	}
+
+	# Where packets of caching ports are kept. Networks share one cache
+	# between all of their ports; ports outside a network get their own.
+	cache = None
+
 	def __init__ (self, *a, **k):
 		Port.__init__(self, *a, **k)
-		self.cache = {}
 
-	def attach (self, socket, index = None):
-		Port.attach(self, socket, index)
+		try:
+			self.copy = self.fanoutPolicies[self.options.get("fanout", "share")]
+		except KeyError:
+			raise Error("Invalid fanout policy {:s} specified".format(self.options["fanout"]))
+
+		self._fanout = ()
+
+	@property
+	def fanout (self):
+		"""All sockets of the port. Listed again only after sockets were
+		attached or detached, rather than for every packet."""
+
+		if self._fanout is None:
+			self._fanout = tuple(self.sockets.itervalues())
+
+		return self._fanout
+
+	def attachSocket (self, socket, index):
+		self._fanout = None
+
+	def detachSocket (self, socket, index):
+		self._fanout = None
+
+	def replayCache (self, socket, index = None):
+		"""Send the cached packets of the port to a newly attached socket,
+		so that it doesn't have to wait for the process to send again.
+
+		Networks call this once the socket is wired up."""
+
+		if not self.caching or self.cache is None:
+			return
+
+		packets = self.cache.get(self, index if self.addressable else None)
 
-		if self.caching and index in self.cache:
-			self.send(self.cache[index], index)
+		if not len(packets):
+			return
+
+		for data in packets:
+			socket.send(data)
+
+		# Leave the connection open if the process is in the middle of
+		# sending to its other sockets
+		if not any(s.connected for s in self.sockets.itervalues() if s is not socket):
+			socket.disconnect()
 
 	def connect (self, socketId = None):
 		sockets = self.getSockets(socketId)
@@ -240,30 +777,55 @@ class OutPort (Port):
 		sockets = self.getSockets(socketId)
 		self.checkRequired(sockets)
 
+		# Sockets connect themselves before the first group or packet
 		for socket in sockets:
-			if socket.connected:
-				socket.beginGroup(group)
-			else:
-				def beginGroup ():
-					socket.off(beginGroup)
-					socket.beginGroup(group)
-
-				socket.on('connect', beginGroup)
-				socket.connect()
+			socket.beginGroup(group)
 
 	def send (self, data, socketId = None):
 		sockets = self.getSockets(socketId)
 		self.checkRequired(sockets)
 
-		for socket in sockets:
-			if socket.connected:
+		if self.caching:
+			self.storeCache(data, socketId if self.addressable else None)
+
+		self._deliver(sockets, data)
+
+	def broadcast (self, data):
+		"""Send a packet to every socket of the port. On addressable ports,
+		this is the same as sending it to each index in turn."""
+
+		self.checkRequired(self.fanout)
+
+		if self.caching:
+			for index in (self.sockets if self.addressable else (None,)):
+				self.storeCache(data, index)
+
+		self._deliver(self.fanout, data)
+
+	def _deliver (self, sockets, data):
+		if self.copy is None or len(sockets) < 2 or type(data) in _immutable:
+			for socket in sockets:
 				socket.send(data)
-			else:
-				def send (_):
-					socket.send(data)
 
-				socket.once('connect', send)
-				socket.connect()
+			return
+
+		# Copies are made from the original before it is handed over, so
+		# what a consumer does with its packet can't affect the others
+		copy = self.copy
+		for socket in sockets[:-1]:
+			socket.send(copy(data))
+
+		sockets[-1].send(data)
+
+	def sendSubstream (self, substream, socketId = None):
+		"""Send a whole L{Substream}. Inports in substream mode receive it
+		in one event; others get its groups and packets one by one."""
+
+		sockets = self.getSockets(socketId)
+		self.checkRequired(sockets)
+
+		for socket in sockets:
+			socket.sendSubstream(substream)
 
 	def endGroup (self, socketId = None):
 		sockets = self.getSockets(socketId)
@@ -295,10 +857,20 @@ class OutPort (Port):
 
 		# Regular sockets affect all outbound connections
 		else:
-			return list(self.sockets.itervalues())
+			return self.fanout
+
+	def storeCache (self, data, index):
+		if self.cache is None:
+			self.cache = PortCache()
+
+		caching = self.options["caching"]
+		depth = 1 if caching is True else int(caching)
+
+		self.cache.store(self, index, data, depth, self.options.get("cacheBytes"))
 
 	@property
 	def caching (self):
+		""" False, or the number of packets cached (True caches one) """
 		return "caching" in self.options and self.options["caching"]
 
 
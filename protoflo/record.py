@@ -0,0 +1,369 @@
+from twisted.internet import reactor, defer
+
+from collections import deque
+from timeit import default_timer
+import functools
+import struct
+
+from codec import registry
+
+# Packet logs record the events flowing through some edges of a network,
+# so that the same load can be fed into a graph again later. The IIPs of
+# the network are always recorded, as they are what starts it.
+#
+# A log starts with a header, followed by records of:
+#
+#     timestamp   double, seconds since the recording started
+#     edge        uint16, edge number
+#     event       uint8, see events below
+#     codec       uint8, id of the codec of the payload, see codec
+#     length      uint32, length of the payload
+#     payload     encoded packet or group, empty for other events
+#
+# Packets are encoded by the codec registered for the datatype of the port
+# they went to. An edge is declared by a record of event 0 before its first
+# event, with the pickled (source, target) endpoint keys of the edge as
+# payload.
+
+magic = "PFLOG"
+version = 2
+
+_header = struct.Struct("<5sB")
+_record = struct.Struct("<dHBBI")
+
+DECLARE = 0
+events = ("connect", "begingroup", "data", "endgroup", "disconnect")
+_codes = dict((event, code) for code, event in enumerate(events, 1))
+
+
+class Recorder (object):
+	"""Record the events of a network to a packet log.
+
+	@type edges: C{list}
+	@param edges: (src, tgt) endpoint dicts of the edges to record besides
+		the IIPs, as in L{network.Edges.find}.
+	"""
+
+	def __init__ (self, network, file, edges = ()):
+		self.network = network
+		self.fp = open(file, "wb")
+		self.fp.write(_header.pack(magic, version))
+		self.start = default_timer()
+		self.sockets = {}
+		self.datatypes = {}
+		self.count = 0
+
+		connections = network.connections
+
+		for socket, (srcKey, tgtKey) in connections.connections.iteritems():
+			if srcKey is None:
+				self.add(socket)
+
+		for src, tgt in edges:
+			sockets = connections.find(src, tgt)
+
+			if not len(sockets):
+				raise Error("No edge from {:s} {:s} to {:s} {:s}".format(
+					src["node"], src["port"].upper(), tgt["node"], tgt["port"].upper()
+				))
+
+			for socket in sockets:
+				self.add(socket)
+
+	def add (self, socket):
+		if socket in self.sockets:
+			return
+
+		# Packets skip the sockets inside fused chains
+		self.network.unfuse(socket)
+
+		edge = len(self.sockets)
+		if edge > 0xffff:
+			raise Error("Too many edges recorded")
+
+		self._write(edge, DECLARE, registry.default.id, registry.default.encode(
+			self.network.connections.connections[socket]
+		))
+
+		tgt = socket.tgt
+		self.datatypes[edge] = tgt["process"].component.inPorts[tgt["port"]].datatype
+
+		handlers = []
+		for event in events:
+			handler = functools.partial(self.record, edge, event)
+			socket.on(event, handler)
+			handlers.append((event, handler))
+
+		handler = functools.partial(self.recordSubstream, edge)
+		socket.on("substream", handler)
+		handlers.append(("substream", handler))
+
+		self.sockets[socket] = handlers
+
+	def record (self, edge, event, data):
+		if event == "data":
+			codec, payload = registry.encode(self.datatypes[edge], data["data"])
+		elif event == "begingroup":
+			codec, payload = registry.default.id, registry.default.encode(data["group"])
+		else:
+			codec, payload = 0, ""
+
+		self._write(edge, _codes[event], codec, payload)
+		self.count += 1
+
+	def recordSubstream (self, edge, data):
+		# Recorded as its groups and packets
+		for event, value in data["substream"].events():
+			if event == "data":
+				self.record(edge, event, { "data": value })
+			elif event == "begingroup":
+				self.record(edge, event, { "group": value })
+			else:
+				self.record(edge, event, {})
+
+	def _write (self, edge, event, codec, payload):
+		self.fp.write(_record.pack(default_timer() - self.start, edge, event, codec, len(payload)))
+		self.fp.write(payload)
+
+	def close (self):
+		for socket, handlers in self.sockets.iteritems():
+			for event, handler in handlers:
+				socket.off(event, handler)
+
+		self.sockets = {}
+		self.fp.close()
+
+
+class Recording (object):
+	"""
+	@type edges: C{list}
+	@ivar edges: (src key, tgt key) of every recorded edge, by edge number.
+
+	@type events: C{list}
+	@ivar events: (timestamp, edge, event, value) tuples, in order.
+	"""
+
+	def __init__ (self, edges, events):
+		self.edges = edges
+		self.events = events
+
+	@property
+	def duration (self):
+		if not len(self.events):
+			return 0.0
+
+		return self.events[-1][0]
+
+
+def load (file):
+	"""Read a packet log. N.B. Blocking function.
+
+	@rtype: L{Recording}
+	"""
+
+	edges = []
+	recorded = []
+
+	with open(file, "rb") as fp:
+		try:
+			fileMagic, fileVersion = _header.unpack(fp.read(_header.size))
+		except struct.error:
+			raise Error("{:s} is not a packet log".format(file))
+
+		if fileMagic != magic:
+			raise Error("{:s} is not a packet log".format(file))
+
+		if fileVersion != version:
+			raise Error("Unsupported packet log version {:d}".format(fileVersion))
+
+		while True:
+			record = fp.read(_record.size)
+
+			if not len(record):
+				break
+
+			try:
+				timestamp, edge, event, codec, length = _record.unpack(record)
+			except struct.error:
+				raise Error("Truncated packet log {:s}".format(file))
+
+			payload = fp.read(length)
+
+			if len(payload) != length:
+				raise Error("Truncated packet log {:s}".format(file))
+
+			if event == DECLARE:
+				edges.append(registry.decode(codec, payload))
+				continue
+
+			value = registry.decode(codec, payload) if codec else None
+			recorded.append((timestamp, edge, events[event - 1], value))
+
+	return Recording(edges, recorded)
+
+
+class Replay (object):
+	"""Feed a recording into a connected network.
+
+	Recorded edges whose target is a process of the network, and whose
+	source is not, are fed: the IIPs of the recording, and the edges coming
+	from processes left out of the graph being benchmarked. IIPs of the
+	network going to a fed port are not sent.
+
+	At speed "original" the events keep their recorded timing; at "max"
+	they are sent as fast as the network takes them, yielding to the
+	reactor between batches.
+
+	Latency is the time the network took to handle a packet sent into it,
+	that is until all the packets it caused were delivered. Asynchronous
+	work of components is not included.
+	"""
+
+	speeds = ("original", "max")
+
+	# Events sent in one reactor turn at speed "max"
+	batch = 1000
+
+	def __init__ (self, network, recording, speed = "original"):
+		if speed not in self.speeds:
+			raise Error("Unknown replay speed {:s}".format(speed))
+
+		self.network = network
+		self.recording = recording
+		self.speed = speed
+		self.latencies = []
+		self.sent = 0
+
+	def prepare (self):
+		"""Find the sockets to feed.
+
+		@return: a Deferred firing once they are attached.
+		"""
+
+		connections = self.network.connections
+		processes = self.network.processes.processes
+		self.sockets = {}
+		waiting = []
+
+		def attached (socket, edge):
+			self.sockets[edge] = socket
+
+		for edge, (srcKey, tgtKey) in enumerate(self.recording.edges):
+			if tgtKey[0] not in processes:
+				continue
+
+			if srcKey is not None and srcKey[0] in processes:
+				continue
+
+			inputs = [
+				socket for socket in connections.byTgt.get(tgtKey, ())
+				if connections.connections[socket][0] is None
+			]
+
+			if len(inputs):
+				self.sockets[edge] = inputs[0]
+				connections.initials = [i for i in connections.initials if i.socket not in inputs]
+				continue
+
+			waiting.append(connections.addInput({
+				"node": tgtKey[0],
+				"port": tgtKey[1],
+				"index": tgtKey[2]
+			}).addCallback(attached, edge))
+
+		return defer.gatherResults(waiting)
+
+	def run (self):
+		"""Replay the recording and start the network.
+
+		@return: a Deferred firing with the report once the network ended.
+		"""
+
+		d = defer.Deferred()
+		self.queue = deque(e for e in self.recording.events if e[1] in self.sockets)
+		self.start = default_timer()
+
+		def ended (data = None):
+			if d.called:
+				return
+
+			self.duration = default_timer() - self.start
+			d.callback(self.report())
+
+		self.ended = ended
+		self.network.hold()
+		self.network.start()
+		self.network.callSoon(self._send)
+
+		return d
+
+	def _send (self):
+		elapsed = default_timer() - self.start
+		sent = 0
+
+		while len(self.queue):
+			timestamp, edge, event, value = self.queue[0]
+
+			if self.speed == "original":
+				if timestamp > elapsed:
+					reactor.callLater(timestamp - elapsed, self.network.callSoon, self._send)
+					return
+			elif sent == self.batch:
+				self.network.callSoon(self._send)
+				return
+
+			self.queue.popleft()
+			self._deliver(self.sockets[edge], event, value)
+			sent += 1
+
+		self._finish()
+
+	def _deliver (self, socket, event, value):
+		start = default_timer()
+
+		if event == "data":
+			socket.send(value)
+			self.latencies.append(default_timer() - start)
+			self.sent += 1
+		elif event == "begingroup":
+			socket.beginGroup(value)
+		elif event == "endgroup":
+			socket.endGroup()
+		elif event == "connect":
+			socket.connect()
+		elif event == "disconnect":
+			socket.disconnect()
+
+	def _finish (self):
+		self.network.once("end", self.ended)
+		self.network.release()
+
+		if not self.network.running:
+			self.ended()
+
+	def report (self):
+		latencies = sorted(self.latencies)
+
+		return {
+			"packets": self.sent,
+			"duration": self.duration,
+			"throughput": self.sent / self.duration if self.duration else 0.0,
+			"latency": dict(
+				(name, percentile(latencies, p))
+				for name, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))
+			)
+		}
+
+
+def percentile (values, p):
+	""" Nearest-rank percentile of sorted [values]. """
+
+	if not len(values):
+		return None
+
+	rank = int(-(-len(values) * p // 100))
+	return values[max(rank, 1) - 1]
+
+
+class Error (Exception):
+	pass
@@ -0,0 +1,162 @@
+from twisted.internet import reactor
+from twisted.python import log
+
+from collections import deque
+from timeit import default_timer
+
+# Several networks running in one runtime share a single reactor. The work
+# of a network (IIPs, packets, results of tracked deferreds) goes through a
+# Scheduler, which hands out reactor time in weighted fair shares:
+# the runnable network which used the least time relative to its weight goes
+# next. After each slice the scheduler yields back to the reactor so that
+# I/O is never starved either.
+#
+# Packets are delivered synchronously within a turn. Once the slice is used
+# up, or when a packet is sent outside of the network's turns (eg from an
+# untracked callback), the socket carrying it is paused until the next turn
+# of its network (see Network.gate), so that long cascades are cut at edge
+# boundaries and accounted to the network they run in.
+
+class Account (object):
+	def __init__ (self, tenant, weight = 1.0, registered = True):
+		self.tenant = tenant
+		self.weight = float(weight)
+		self.registered = registered
+
+		# Time spent in the turns of the tenant. Work its components do
+		# outside of them, before sending a packet, is not accounted.
+		self.vtime = 0.0   # divided by the weight
+		self.cpu = 0.0     # in seconds
+		self.tasks = 0
+		self.queue = deque()
+
+
+class Scheduler (object):
+	# Seconds of work done in one reactor turn before yielding to I/O
+	slice = 0.005
+
+	def __init__ (self):
+		self.accounts = {}
+		self.clock = 0.0
+		self.call = None
+
+		# The account whose task is running, and when its turn ends
+		self.current = None
+		self.deadline = 0.0
+
+	def register (self, tenant, weight = 1.0):
+		if weight <= 0:
+			raise Error("Scheduling weight must be positive")
+
+		try:
+			account = self.accounts[tenant]
+		except KeyError:
+			self.accounts[tenant] = Account(tenant, weight)
+		else:
+			account.weight = float(weight)
+			account.registered = True
+
+	def unregister (self, tenant):
+		"""Forget [tenant]. Work it has already scheduled still runs, and
+		its account goes once that is done."""
+
+		try:
+			account = self.accounts[tenant]
+		except KeyError:
+			return
+
+		account.registered = False
+		self._discard(account)
+
+	def schedule (self, tenant, f, *args, **kwargs):
+		""" Run f(*args, **kwargs) during [tenant]'s share of the reactor. """
+
+		try:
+			account = self.accounts[tenant]
+		except KeyError:
+			# Tenants that never registered are only accounted for while
+			# they have work queued
+			account = self.accounts[tenant] = Account(tenant, registered = False)
+
+		# A network that was idle doesn't get to catch up on the time it
+		# did not use
+		if not len(account.queue):
+			account.vtime = max(account.vtime, self.clock)
+
+		account.queue.append((f, args, kwargs))
+
+		if self.call is None:
+			self.call = reactor.callLater(0, self._run)
+
+	def running (self, tenant):
+		""" Whether [tenant] is in a turn of its own with time left. """
+
+		current = self.current
+
+		return current is not None and current.tenant is tenant and default_timer() < self.deadline
+
+	def stats (self, tenant):
+		try:
+			account = self.accounts[tenant]
+		except KeyError:
+			return None
+
+		if not account.registered:
+			return None
+
+		return {
+			"weight": account.weight,
+			"cpu": account.cpu,
+			"tasks": account.tasks,
+			"queued": len(account.queue)
+		}
+
+	def _next (self):
+		runnable = [account for account in self.accounts.itervalues() if len(account.queue)]
+
+		if not len(runnable):
+			return None
+
+		return min(runnable, key = lambda account: account.vtime)
+
+	def _discard (self, account):
+		if not account.registered and not len(account.queue):
+			self.accounts.pop(account.tenant, None)
+
+	def _run (self):
+		# self.call stays set while running, so that tasks scheduling more
+		# work don't queue extra runs
+		deadline = self.deadline = default_timer() + self.slice
+
+		while True:
+			account = self._next()
+
+			if account is None:
+				self.call = None
+				return
+
+			if default_timer() >= deadline:
+				break
+
+			f, args, kwargs = account.queue.popleft()
+			self.clock = account.vtime
+
+			start = default_timer()
+			self.current = account
+			try:
+				f(*args, **kwargs)
+			except:
+				log.err(None, "Scheduled task failed")
+			finally:
+				self.current = None
+				elapsed = default_timer() - start
+				account.cpu += elapsed
+				account.vtime += elapsed / account.weight
+				account.tasks += 1
+				self._discard(account)
+
+		self.call = reactor.callLater(0, self._run)
+
+
+class Error (Exception):
+	pass
@@ -1,5 +1,7 @@
 from ...network import Network
+from ...scheduler import Scheduler
 from twisted.python import log
+from twisted.internet import reactor
 
 def prepareSocketEvent (event, req):
 	payload = {
@@ -33,11 +35,142 @@ def prepareSocketEvent (event, req):
 
 	return payload
 
+
+# Sampling of network:data events. A traced edge may carry far more packets
+# than is useful (or possible) to send to the UI, so each selected edge can
+# have a policy deciding which of its data events are sent. Every event that
+# is sent carries the number of events dropped since the previous one.
+
+class Sampler (object):
+	def __init__ (self):
+		self.dropped = 0   # since the last event sent
+		self.total = 0     # over the lifetime of the sampler
+
+	def offer (self, event, send):
+		"""Called with each data event, and a function send(event, dropped)"""
+		raise NotImplementedError
+
+	def drop (self):
+		self.dropped += 1
+		self.total += 1
+
+	def release (self, event, send):
+		dropped, self.dropped = self.dropped, 0
+		send(event, dropped)
+
+	def stop (self):
+		pass
+
+
+class EverySampler (Sampler):
+	""" Sends the first of every [every] events. """
+
+	def __init__ (self, every):
+		Sampler.__init__(self)
+		self.every = max(1, int(every))
+		self.count = 0
+
+	def offer (self, event, send):
+		self.count += 1
+
+		if self.count == 1:
+			self.release(event, send)
+		else:
+			self.drop()
+
+		if self.count == self.every:
+			self.count = 0
+
+
+class RateSampler (Sampler):
+	""" Sends at most [rate] events per second. """
+
+	def __init__ (self, rate):
+		Sampler.__init__(self)
+		self.rate = float(rate)
+		self.allowance = max(1.0, self.rate)
+		self.last = reactor.seconds()
+
+	def offer (self, event, send):
+		now = reactor.seconds()
+		self.allowance = min(
+			max(1.0, self.rate),
+			self.allowance + (now - self.last) * self.rate
+		)
+		self.last = now
+
+		if self.allowance >= 1.0:
+			self.allowance -= 1.0
+			self.release(event, send)
+		else:
+			self.drop()
+
+
+class LatestSampler (Sampler):
+	""" Sends the latest event once per frame, [fps] frames per second. """
+
+	def __init__ (self, fps = 30):
+		Sampler.__init__(self)
+		self.interval = 1.0 / float(fps)
+		self.pending = None
+		self.call = None
+
+	def offer (self, event, send):
+		if self.pending is not None:
+			self.drop()
+
+		self.pending = (event, send)
+
+		if self.call is None:
+			self.call = reactor.callLater(self.interval, self.flush)
+
+	def flush (self):
+		self.call = None
+
+		if self.pending is not None:
+			event, send = self.pending
+			self.pending = None
+			self.release(event, send)
+
+	def stop (self):
+		if self.call is not None:
+			self.call.cancel()
+			self.call = None
+
+		self.pending = None
+
+
+def createSampler (spec):
+	"""Create a sampler from its network:edges description, one of:
+		{ "every": N }, { "rate": events per second }, { "latest": fps }
+	"""
+
+	if spec is None:
+		return None
+
+	try:
+		if "every" in spec:
+			return EverySampler(spec["every"])
+		if "rate" in spec:
+			return RateSampler(spec["rate"])
+		if "latest" in spec:
+			if spec["latest"] is True:
+				return LatestSampler()
+			return LatestSampler(spec["latest"])
+	except (TypeError, ValueError, ZeroDivisionError):
+		pass
+
+	raise Error("Invalid sampling policy {!r}".format(spec))
+
+
 class NetworkProtocol (object):
 	def __init__ (self, transport):
 		self.transport = transport
 		self.networks = {}
 
+		# All networks of the runtime share the reactor fairly
+		self.scheduler = Scheduler()
+
 	def send (self, topic, payload, context):
 		self.transport.send('network', topic, payload, context)
 
@@ -71,6 +204,15 @@ class NetworkProtocol (object):
 		graph.componentLoader = self.transport.component.getLoader() #graph.baseDir
 
 		def networkReady (network):
+			if payload["graph"] in self.networks:
+				self.scheduler.unregister(self.networks[payload["graph"]].tenant)
+
+			network.scheduler = self.scheduler
+			self.scheduler.register(network.tenant, payload.get("weight", 1.0))
+
+			if "validation" in payload:
+				network.setValidation(payload["validation"])
+
 			self.networks[payload["graph"]] = network
 			self.subscribeNetwork(network, payload, context)
 
@@ -82,7 +224,7 @@ class NetworkProtocol (object):
 			def initNetwork_addInitial(data):
 				network.connections.sendInitials().addErrback(error)
 
-			return network.connections.sendInitials()
+			return network.start()
 
 		def error (failure):
 			if failure.type.__name__ != "Error":
@@ -112,13 +254,29 @@ class NetworkProtocol (object):
 		def handle (event):
 			def subscribeNetwork_handle (data):
 				if "socket" in data:
-					if data['socket'].id not in context.selectedEdges:
+					if data['socket'] not in context.selectedEdges:
 						return
 
+					if event == 'data':
+						try:
+							sampler = context.samplers[payload["graph"], data["socket"]]
+						except (AttributeError, KeyError):
+							pass
+						else:
+							return sampler.offer(data, sendData)
+
 				self.send(event, prepareSocketEvent(data, payload), context)
 
 			return subscribeNetwork_handle
 
+		def sendData (data, dropped):
+			event = prepareSocketEvent(data, payload)
+
+			if dropped:
+				event["dropped"] = dropped
+
+			self.send('data', event, context)
+
 		for event in ('connect', 'begingroup', 'data', 'endgroup', 'disconnect'):
 			network.on(event, handle(event))
 
@@ -137,7 +295,13 @@ class NetworkProtocol (object):
 		if payload["graph"] not in self.networks:
 			return
 
-		self.networks[payload["graph"]].stop()
+		def error (failure):
+			log.err(failure)
+			self.send('error', failure.value, context)
+
+		self.networks[payload["graph"]] \
+		.stop(payload.get("drain", False), payload.get("timeout")) \
+		.addErrback(error)
 
 	def getStatus (self, graph, payload, context):
 		network = self.networks[payload['graph']]
@@ -146,6 +310,25 @@ class NetworkProtocol (object):
 			'started': network.running,
 			'running': False, # FIXME: determine how to get this
 		}
+
+		# Share of the reactor used by the network
+		scheduling = self.scheduler.stats(network.tenant)
+		if scheduling is not None:
+			data['scheduling'] = scheduling
+
+		# Data events not sent to this client because of edge sampling
+		dropped = sum(
+			sampler.total
+			for key, sampler in getattr(context, "samplers", {}).iteritems()
+			if key[0] == payload['graph']
+		)
+
+		if dropped:
+			data['dropped'] = dropped
+
+		if network.validationMode != "off":
+			data['validation'] = network.validationStats.asDict()
+
 		self.send('status', data, context)
 
 	def selectEdges (self, graph, payload, context):
@@ -155,20 +338,77 @@ class NetworkProtocol (object):
 		# TODO: make this work without the network.
 
 		network = self.networks[payload["graph"]]
-		selected = []
+		sockets = []
+
+		endpoint = lambda e: {
+			"node": e["process"],
+			"port": e["port"],
+			"index": e.get("index")
+		}
+
+		self.stopSamplers(payload["graph"], context)
+
+		if not hasattr(context, "samplers"):
+			context.samplers = {}
 
 		for edge in payload["edges"]:
-			for connection in network.connections:
-				if connection.src is None or "process" not in connection.src:
-					continue
+			# Sampling policy of this edge, or the default of the request
+			sampling = edge.get("sample", payload.get("sample"))
+
+			# Sockets are kept rather than their ids, which change when
+			# nodes are renamed
+			for connection in network.connections.find(endpoint(edge["src"]), endpoint(edge["tgt"])):
+				sockets.append(connection)
+
+				sampler = createSampler(sampling)
+				if sampler is not None:
+					context.samplers[payload["graph"], connection] = sampler
+
+		# The network only forwards the events of sockets somebody traces.
+		# Trace the new selection before releasing the old one, so that
+		# edges which stay selected are not unsubscribed in between.
+		for socket in sockets:
+			network.traceSocket(socket)
+
+		self.untraceEdges(payload["graph"], context)
 
-				if edge["tgt"]["process"] == connection.tgt["process"].id and edge["tgt"]["port"] == connection.tgt["port"]:
-					if edge["src"]["process"] == connection.src["process"].id and edge["src"]["port"] == connection.src["port"]:
-						selected.append(connection.id)
+		if not hasattr(context, "tracedSockets"):
+			context.tracedSockets = {}
+
+		context.tracedSockets[payload["graph"]] = sockets
 
 		# Store this in the context so that it is individual to the client
 		# [ Can two clients connect to the same network?? ]
-		context.selectedEdges = selected
+		context.selectedEdges = set(sockets)
+
+	def untraceEdges (self, graphId, context):
+		try:
+			sockets = context.tracedSockets.pop(graphId)
+		except (AttributeError, KeyError):
+			return
+
+		try:
+			network = self.networks[graphId]
+		except KeyError:
+			return
+
+		for socket in sockets:
+			network.untraceSocket(socket)
+
+	def stopSamplers (self, graphId, context):
+		samplers = getattr(context, "samplers", {})
+
+		for key in [key for key in samplers if key[0] == graphId]:
+			samplers.pop(key).stop()
+
+	def releaseContext (self, context):
+		""" Stop tracing the edges selected by a client that went away. """
+
+		for graphId in list(getattr(context, "tracedSockets", ())):
+			self.untraceEdges(graphId, context)
+			self.stopSamplers(graphId, context)
+
+		context.selectedEdges = set()
 
 class Error (Exception):
 	pass
@@ -3,9 +3,8 @@ from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflat
 from twisted.python import log
 from twisted.internet import reactor
 
-import json
-
 from transport.base import BaseTransport
+from .. import codec
 
 class WebSocketRuntime (BaseTransport):
 	def __init__ (self):
@@ -34,25 +33,38 @@ class WebSocketRuntime (BaseTransport):
 
 		log.msg("Response", response)
 
-		context.sendMessage(json.dumps(response))
+		# Messages are objects, encoded by the codec clients read them with
+		try:
+			_, message = codec.clients.encode("object", response)
+		except codec.Error as e:
+			# Sending a packet clients can't read is an error, rather than
+			# a silent change of the packet
+			log.msg("Cannot send {:s}:{:s}: {:s}".format(protocol, topic, e))
+
+			if topic == "error":
+				return
+
+			return self.send(protocol, "error", e, context)
+
+		context.sendMessage(message)
 
 class NoFloUiProtocol (WebSocketServerProtocol): 
 	def onConnect (self, request):
 		return 'noflo'
 
 	def onOpen (self):
-		self.selectedEdges = []
+		self.selectedEdges = set()
 		self.sendPing()
 		pass
 
 	def onClose (self, wasClean, code, reason):
-		pass
+		self.factory.runtime.network.releaseContext(self)
 
 	def onMessage (self, payload, isBinary):
 		if isBinary:
 			raise ValueError("WebSocket message must be UTF-8")
 
-		cmd = json.loads(payload)
+		cmd = codec.clients.get("object").decode(payload)
 
 		log.msg("Command", cmd)
 
@@ -1,16 +1,52 @@
 
 from util import EventEmitter
 
-class InternalSocket (EventEmitter):
-	src = None
-	tgt = None
+from collections import deque
 
+class InternalSocket (EventEmitter):
 	def __init__ (self):
 		self.connected = False
 		self.groups = []
+		self._src = None
+		self._tgt = None
+		self._id = None
+		self.paused = False
+		self.pauses = 0
+		self.flushing = False
+		self.queue = None
+		self.closed = False
+		self.dropped = 0
+
+		# Whether the inport at the end takes whole substreams
+		self.substreams = False
+
+		# Called before an event is delivered, and may pause the socket to
+		# have it wait (see Network.gate)
+		self.gate = None
+
+	def _setSrc (self, src):
+		self._src = src
+		self._id = None
+
+	def _setTgt (self, tgt):
+		self._tgt = tgt
+		self._id = None
+
+	src = property(lambda self: self._src, _setSrc)
+	tgt = property(lambda self: self._tgt, _setTgt)
 
 	@property
 	def id (self):
+		if self._id is None:
+			self._id = self._formatId()
+
+		return self._id
+
+	def resetId (self):
+		""" Forget the cached id, eg after renaming one of the processes. """
+		self._id = None
+
+	def _formatId (self):
 		_from = lambda f: "{0:s}() {1:s}".format(f["process"].id, f["port"].upper())
 		_to = lambda f: "{1:s} {0:s}()".format(f["process"].id, f["port"].upper())
 
@@ -28,30 +64,180 @@ class InternalSocket (EventEmitter):
 			except AttributeError:
 				return "UNDEFINED"
 
+	# While a socket is paused, its events are queued instead of being
+	# delivered, and replayed in order when it resumes. Pauses nest: the
+	# network and a full inport may both hold the socket, and it resumes
+	# once both let go.
+
+	def pause (self):
+		self.pauses += 1
+		self.paused = True
+
+		if self.queue is None:
+			self.queue = deque()
+
+	def resume (self):
+		if self.pauses > 1:
+			self.pauses -= 1
+			return
+
+		self.pauses = 0
+		self.paused = False
+
+		# Resumed from within the replay below, which carries on
+		if self.queue is None or self.flushing:
+			return
+
+		self.flushing = True
+		try:
+			# Events sent to the socket during the replay are queued behind
+			# the ones already waiting, until the socket is paused again,
+			# by its gate too
+			while len(self.queue):
+				if self.gate is not None:
+					self.gate(self)
+
+				if self.paused:
+					break
+
+				event, value = self.queue.popleft()
+				self._deliver(event, value)
+		finally:
+			self.flushing = False
+
+		if not self.paused:
+			self.queue = None
+
+	def _waits (self):
+		if self.queue is None and self.gate is not None:
+			self.gate(self)
+
+		return self.queue is not None
+
+	def _deliver (self, event, value):
+		if event == "data":
+			self._send(value)
+		elif event == "connect":
+			self._connect()
+		elif event == "disconnect":
+			self._disconnect()
+		elif event == "begingroup":
+			self._beginGroup(value)
+		elif event == "endgroup":
+			self._endGroup()
+		elif event == "substream":
+			self._sendSubstream(value)
+
+	def close (self):
+		"""Stop accepting events. Packets sent to a closed socket are
+		counted as dropped; events queued before closing are still
+		delivered on resume, followed by a disconnect."""
+
+		if self.closed:
+			return
+
+		self.closed = True
+
+		if self.queue is not None:
+			self.queue.append(("disconnect", None))
+		else:
+			self._disconnect()
+
 	def connect (self):
+		if self.closed:
+			return
+
+		if self._waits():
+			self.queue.append(("connect", None))
+		else:
+			self._connect()
+
+	def disconnect (self):
+		if self.closed:
+			return
+
+		if self._waits():
+			self.queue.append(("disconnect", None))
+		else:
+			self._disconnect()
+
+	def send (self, data):
+		if self.closed:
+			self.dropped += 1
+			return
+
+		if self._waits():
+			self.queue.append(("data", data))
+		else:
+			self._send(data)
+
+	def beginGroup (self, group):
+		if self.closed:
+			return
+
+		if self._waits():
+			self.queue.append(("begingroup", group))
+		else:
+			self._beginGroup(group)
+
+	def endGroup (self):
+		if self.closed:
+			return
+
+		if self._waits():
+			self.queue.append(("endgroup", None))
+		else:
+			self._endGroup()
+
+	def sendSubstream (self, substream):
+		if self.closed:
+			self.dropped += sum(1 for event, _ in substream.events() if event == "data")
+			return
+
+		if self._waits():
+			self.queue.append(("substream", substream))
+		else:
+			self._sendSubstream(substream)
+
+	def _sendSubstream (self, substream):
+		# Sent as one event to inports in substream mode, as its groups
+		# and packets otherwise
+		if self.substreams:
+			if not self.connected:
+				self._connect()
+
+			self.emit("substream", substream = substream)
+			return
+
+		for event, value in substream.events():
+			self._deliver(event, value)
+
+	def _connect (self):
 		if self.connected:
 			return
 
 		self.connected = True
 		self.emit("connect", socket = self)
 
-	def disconnect (self):
+	def _disconnect (self):
 		if not self.connected:
 			return
 
 		self.connected = False
 		self.emit("disconnect", socket = self)
 
-	def send (self, data):
+	def _send (self, data):
 		if not self.connected:
-			self.connect()
+			self._connect()
 
 		self.emit('data', data = data)
 
-	def beginGroup (self, group):
+	def _beginGroup (self, group):
+		if not self.connected:
+			self._connect()
+
 		self.groups.append(group)
 		self.emit("begingroup", group = group)
 
-	def endGroup (self):
+	def _endGroup (self):
 		self.emit("endgroup", group = self.groups.pop())
-
@@ -1,6 +1,8 @@
 from twisted.internet import reactor
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
 import functools
+import os
+import tempfile
 from itertools import chain
 
 class EventEmitter (object):
@@ -55,9 +57,13 @@ class EventEmitter (object):
 			except KeyError:
 				pass
 		
-		# Remove handler [function] from [name]
+		# Remove handler [function] from [name]. The list is replaced
+		# rather than changed, so that an emit going through it, eg one
+		# calling a once() handler, doesn't skip the next handler.
 		else:
-			self._events[name].remove(function)
+			functions = list(self._events[name])
+			functions.remove(function)
+			self._events[name] = functions
 
 	def listeners (self, event):
 		try:
@@ -66,28 +72,26 @@ class EventEmitter (object):
 			return []
 	
 	def emit (self, _event, **data):
-		handled = False
-
 		try:
-			events = self._events[_event]
-		except AttributeError:
+			events = self._events
+		except (AttributeError, KeyError):
 			return False # No events defined yet
-		except KeyError:
-			pass
-		else:
-			handled |= bool(len(events))
 
-			for function in events:
+		handled = False
+		functions = events.get(_event)
+
+		if functions:
+			handled = True
+
+			for function in functions:
 				function(data)
 
-		try:
-			events = self._events["all"]
-		except KeyError:
-			pass
-		else:
-			handled |= bool(len(events))
+		functions = events.get("all")
+
+		if functions:
+			handled = True
 
-			for function in events:
+			for function in functions:
 				function(_event, data)
 
 		return handled
@@ -112,3 +116,38 @@ def debounce (wait):
 
 		return debounced
 	return decorator
+
+
+def atomicWrite (path, chunks):
+	""" Write an iterable of strings to [path], replacing any existing
+		file only once all of the data has been written. """
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, temp = tempfile.mkstemp(dir = directory, prefix = ".", suffix = ".tmp")
+
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			for chunk in chunks:
+				f.write(chunk)
+
+			f.flush()
+			os.fsync(f.fileno())
+
+		# mkstemp() creates the file private to the user
+		try:
+			mode = os.stat(path).st_mode
+		except OSError:
+			umask = os.umask(0)
+			os.umask(umask)
+			mode = 0666 & ~umask
+
+		os.chmod(temp, mode)
+
+		# rename() can't replace an existing file on Windows
+		if os.name == "nt" and os.path.exists(path):
+			os.remove(path)
+
+		os.rename(temp, path)
+	except:
+		if os.path.exists(temp):
+			os.remove(temp)
+		raise
@@ -0,0 +1,213 @@
+from twisted.python import log
+
+import datetime
+import numbers
+
+# Packets arriving at an inport can be checked against what the port
+# declares: its datatype, its enumeration of "values", and an optional
+# "schema". All of them are compiled into a single check per port when the
+# port is wired, so that ports declaring nothing cost nothing.
+#
+# A network validates in one of these modes:
+#
+#     strict    every packet is checked, invalid ones are dropped
+#     sampled   one packet in every few is checked, and always delivered
+#     off       nothing is checked
+
+modes = ("strict", "sampled", "off")
+
+
+def _isNumber (data):
+	# Number ports cast what they receive, elementwise for sequences and
+	# arrays (see protoflo_math), so numeric strings and vectors are valid
+	if isinstance(data, bool):
+		return False
+
+	if isinstance(data, numbers.Real):
+		return True
+
+	if isinstance(data, basestring):
+		try:
+			float(data)
+		except ValueError:
+			return False
+
+		return True
+
+	if isinstance(data, (list, tuple)):
+		return all(_isNumber(v) for v in data)
+
+	# NumPy arrays, without importing NumPy
+	dtype = getattr(data, "dtype", None)
+	return dtype is not None and getattr(dtype, "kind", None) in ('i', 'u', 'f')
+
+def _isInt (data):
+	return isinstance(data, numbers.Integral) and not isinstance(data, bool)
+
+_typeChecks = {
+	"string": lambda data: isinstance(data, basestring),
+	"number": _isNumber,
+	"int": _isInt,
+	"object": lambda data: isinstance(data, dict),
+	"array": lambda data: isinstance(data, (list, tuple)),
+	"boolean": lambda data: isinstance(data, bool),
+	"color": lambda data: isinstance(data, basestring),
+	"date": lambda data: isinstance(data, (datetime.date, basestring)),
+	"function": callable,
+	"buffer": lambda data: isinstance(data, (str, bytearray, buffer, memoryview)),
+}
+
+
+def _schemaCheck (schema):
+	# A schema is either a predicate, or a dict of the keys a packet must
+	# have to the datatype of their value
+	if callable(schema):
+		return lambda data: None if schema(data) else "does not match the schema"
+
+	fields = [(key, _typeChecks.get(datatype)) for key, datatype in schema.iteritems()]
+
+	def check (data):
+		if not isinstance(data, dict):
+			return "is not an object"
+
+		for key, typeCheck in fields:
+			if key not in data:
+				return "has no '{:s}'".format(key)
+
+			if typeCheck is not None and not typeCheck(data[key]):
+				return "has an invalid '{:s}'".format(key)
+
+	return check
+
+
+def _valuesCheck (values):
+	# Hashable packets are looked up in a set, others (lists, dicts...)
+	# compared with each of the values
+	values = tuple(values)
+
+	try:
+		lookup = frozenset(values)
+	except TypeError:
+		lookup = None
+
+	message = "is not one of the allowed values"
+
+	def check (data):
+		if lookup is not None:
+			try:
+				return None if data in lookup else message
+			except TypeError:
+				pass
+
+		return None if data in values else message
+
+	return check
+
+
+def compile (port):
+	"""Compile the declarations of an inport into one check.
+
+	@return: a function of a packet returning None when it is valid, or
+		what is wrong with it. None when the port accepts anything.
+	"""
+
+	checks = []
+	datatype = port.datatype
+
+	typeCheck = _typeChecks.get(datatype)
+	if typeCheck is not None:
+		message = "is not of type {:s}".format(datatype)
+		checks.append(lambda data: None if typeCheck(data) else message)
+
+	values = port.options.get("values")
+	if values is not None:
+		checks.append(_valuesCheck(values))
+
+	schema = port.options.get("schema")
+	if schema is not None:
+		checks.append(_schemaCheck(schema))
+
+	if not len(checks):
+		return None
+
+	if len(checks) == 1:
+		return checks[0]
+
+	def check (data):
+		for check in checks:
+			error = check(data)
+
+			if error is not None:
+				return error
+
+	return check
+
+
+class Stats (object):
+	"""
+	@ivar checked: Number of packets checked.
+	@ivar violations: Number of invalid packets found.
+	@ivar dropped: Number of invalid packets dropped.
+	@ivar ports: Port id to the number of invalid packets found there.
+	"""
+
+	def __init__ (self):
+		self.checked = 0
+		self.violations = 0
+		self.dropped = 0
+		self.ports = {}
+
+	def asDict (self):
+		return {
+			"checked": self.checked,
+			"violations": self.violations,
+			"dropped": self.dropped,
+			"ports": dict(self.ports)
+		}
+
+
+class PortValidator (object):
+	"""Installed on an inport, tells whether to deliver a packet."""
+
+	__slots__ = ("port", "check", "stats", "mode", "every", "countdown")
+
+	def __init__ (self, port, check, stats, mode = "strict", every = 100):
+		self.port = port
+		self.check = check
+		self.stats = stats
+		self.mode = mode
+		self.every = every
+		self.countdown = 1
+
+	def __call__ (self, data):
+		if self.mode == "sampled":
+			self.countdown -= 1
+
+			if self.countdown:
+				return True
+
+			self.countdown = self.every
+
+		stats = self.stats
+		stats.checked += 1
+
+		error = self.check(data)
+
+		if error is None:
+			return True
+
+		stats.violations += 1
+
+		# Only the first violation of each port is logged
+		portId = self.port.id
+		if portId not in stats.ports:
+			log.msg("{:s}: packet {:s}: {!r}".format(portId, error, data))
+			stats.ports[portId] = 0
+
+		stats.ports[portId] += 1
+
+		if self.mode == "strict":
+			stats.dropped += 1
+			return False
+
+		return True
@@ -1,4 +1,5 @@
 from protoflo.component import Component
+from protoflo.helper import MapComponent
 from protoflo.port import InPorts, OutPorts
 
 name = "core"
@@ -118,33 +119,23 @@ class Output (Component):
 		print data
 
 
-class Repeat (Component):
-
-	description = """This component receives input on a single inport, and
-		passes the data to its outport unchanged"""
-	icon = 'bug'
-
-	def initialize (self, **options):
-		self.inPorts = InPorts()
-		self.inPorts["in"] = {
+def Repeat (metadata = None):
+	c = Component(
+		inPorts = [('in', {
 			"datatype": 'all',
 			"description": 'Packet to be passed on'
-		}
-		self.outPorts = OutPorts()
-		self.outPorts["out"] = { "datatype": 'all' }
+		})],
+		outPorts = [('out', { "datatype": 'all' })]
+	)
 
-		inPort = self.inPorts["in"]
-		outPort = self.outPorts["out"]
+	c.description = """This component receives input on a single inport, and
+		passes the data to its outport unchanged"""
+	c.icon = 'bug'
 
-		@inPort.on('data')
-		def onData (data):
-			if outPort.attached:
-				outPort.send(data["data"])
+	def process (data, groups, outPort):
+		outPort.send(data['data'])
 
-		@inPort.on('disconnect')
-		def onDisconnect (data):
-			if outPort.attached:
-				outPort.disconnect()
+	return MapComponent(c, process)
 
 __components__ = {
 	'Kick': Kick,
@@ -1,6 +1,11 @@
 from protoflo.component import Component
 from protoflo.port import InPorts, OutPorts
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 def _toNumber(s):
 	"""Cast a string to an int or float"""
 	if not isinstance(s, basestring):
@@ -10,8 +15,78 @@ def _toNumber(s):
 	except ValueError:
 		return float(s)
 
+def _hasStrings (value):
+	if isinstance(value, (list, tuple)):
+		return any(_hasStrings(v) for v in value)
+
+	return isinstance(value, basestring)
+
+def _toList (value, cast):
+	if isinstance(value, (list, tuple)):
+		return [_toList(v, cast) for v in value]
+
+	return cast(value)
+
+def _toOperand (value):
+	"""Cast a packet to an operand: a number, or a sequence of numbers.
+	With NumPy, sequences are left for L{_toArray} to cast in one go.
+	Without it, they are cast to lists the same way: a sequence holding
+	strings becomes floats throughout, any other keeps its numbers."""
+
+	if isinstance(value, (list, tuple)):
+		if numpy is None:
+			return _toList(value, float if _hasStrings(value) else (lambda v: v))
+
+		return value
+
+	return _toNumber(value)
+
+def _toArray (value):
+	"""Cast a sequence operand to a NumPy array, strings included."""
+
+	if not isinstance(value, (list, tuple)):
+		return value
+
+	array = numpy.asarray(value)
+
+	if array.dtype.kind not in 'biuf':
+		array = array.astype(float)
+
+	return array
+
+def _elementwise (op, a, b):
+	"""Apply op elementwise, broadcasting scalars over sequences.
+	Used without NumPy; NumPy arrays broadcast by themselves."""
+
+	aSequence = isinstance(a, list)
+	bSequence = isinstance(b, list)
+
+	if aSequence and bSequence:
+		if len(a) != len(b):
+			raise ValueError("Cannot combine sequences of lengths {:d} and {:d}".format(len(a), len(b)))
+
+		return [_elementwise(op, x, y) for x, y in zip(a, b)]
+
+	if aSequence:
+		return [_elementwise(op, x, b) for x in a]
+
+	if bSequence:
+		return [_elementwise(op, a, y) for y in b]
+
+	return op(a, b)
+
 class _MathComponent (Component):
+	# Regions of math components can be fused into one compiled expression
+	# (see protoflo.fusion). The operator is None for components which
+	# must be called through calculate().
+	expressionOperator = None
+	expressionOptions = ()
+
+	operand = staticmethod(_toOperand)
+
 	def initialize (self, primary, secondary, res, inputType = 'number'):
+		self.expressionPorts = (primary, secondary, res)
+
 		self.inPorts = InPorts()
 		self.inPorts[primary] =	{ 'datatype': inputType }
 		self.inPorts[secondary] = { 'datatype': inputType }
@@ -34,11 +109,16 @@ class _MathComponent (Component):
 		self.groups = []
 
 		def calculate ():
+			try:
+				result = self.compute(self.primary['value'], self.secondary)
+			except Exception as e:
+				return self.computeFailed(e)
+
 			for group in self.primary["group"]:
 				resPort.beginGroup(group)
 
 			if self.outPorts[res].attached:
-				resPort.send(self.calculate(self.primary['value'], self.secondary))
+				resPort.send(result)
 
 			for group in self.primary['group']:
 				resPort.endGroup()
@@ -48,22 +128,17 @@ class _MathComponent (Component):
 
 		@primaryPort.on('begingroup')
 		def onBeginGroup (data):
-			self.groups.push(data['group'])
+			self.groups.append(data['group'])
 
 		@primaryPort.on('data') 
 		def onData (data):
 			self.primary = {
-				"value": _toNumber(data['data']),
+				"value": _toOperand(data['data']),
 				"group": self.groups[:],
 				"disconnect": False
 			}
 			if self.secondary is not None:
-				try:
-					calculate()
-				except TypeError:
-					self.error(TypeError("Must pass numbers to mathematical components"))
-				except Exception as e:
-					self.error(e)
+				calculate()
 
 		@primaryPort.on('endgroup')
 		def onEndGroup (data):
@@ -76,18 +151,18 @@ class _MathComponent (Component):
 
 		@secondaryPort.on('data') 
 		def onData (data):
-			self.secondary = _toNumber(data['data'])
+			self.secondary = _toOperand(data['data'])
 			if self.primary['value'] is not None:
 				calculate()
 
 		@clearPort.on('data') 
 		def onData (data):
-			if resPorts.connected:
+			if resPort.connected:
 				for group in self.primary['group']:
-					self.resPort.endGroup()
+					resPort.endGroup()
 
 				if self.primary['disconnect']:
-					self.resPort.disconnect()
+					resPort.disconnect()
 
 			self.primary = {
 				"value": None,
@@ -97,9 +172,46 @@ class _MathComponent (Component):
 			self.secondary = None
 			self.groups = []
 
+	def computeFailed (self, e):
+		if isinstance(e, TypeError):
+			e = TypeError("Must pass numbers to mathematical components")
+
+		self.error(e)
+
+	def getState (self):
+		return {
+			"primary": dict(self.primary, group = list(self.primary["group"])),
+			"secondary": self.secondary,
+			"groups": list(self.groups)
+		}
+
+	def setState (self, state):
+		self.primary = state["primary"]
+		self.secondary = state["secondary"]
+		self.groups = state["groups"]
+
+	def compute (self, a, b):
+		"""Calculate the result of two operands, elementwise when either is
+		a sequence, in one call with NumPy. The result is an array if an
+		operand is an array, a list if an operand is a sequence."""
+
+		if numpy is None:
+			return _elementwise(self.calculate, a, b)
+
+		sequences = isinstance(a, (list, tuple)) or isinstance(b, (list, tuple))
+
+		if not sequences:
+			return self.calculate(a, b)
+
+		arrays = isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray)
+		result = self.calculate(_toArray(a), _toArray(b))
+
+		return result if arrays else result.tolist()
+
 
 class Add (_MathComponent):
 	icon = 'plus'
+	expressionOperator = '+'
 
 	def initialize (self):
 		_MathComponent.initialize(self, 'augend', 'addend', 'sum')
@@ -110,6 +222,7 @@ class Add (_MathComponent):
 
 class Subtract (_MathComponent):
 	icon = 'minus'
+	expressionOperator = '-'
 
 	def initialize (self):
 		_MathComponent.initialize(self, 'minuend', 'subtrahend', 'difference')
@@ -120,6 +233,7 @@ class Subtract (_MathComponent):
 
 class Multiply (_MathComponent):
 	icon = 'asterisk'
+	expressionOperator = '*'
 
 	def initialize (self):
 		_MathComponent.initialize(self, 'multiplicand', 'multiplier', 'product')
@@ -129,10 +243,71 @@ class Multiply (_MathComponent):
 
 
 class Divide (_MathComponent):
+	"""Divides by zero according to its "zerodivision" policy:
+
+	    error   fail, the default
+	    inf     signed infinity, NaN for 0 / 0
+	    nan     NaN
+	    zero    0.0
+	"""
+
+	zeroDivisionPolicies = ('error', 'inf', 'nan', 'zero')
+
+	# The policy is read by calculate(), so it can change while fused
+	expressionOptions = ('zerodivision',)
+
 	def initialize (self):
 		_MathComponent.initialize(self, 'dividend', 'divisor', 'quotient')
 
+		self.zeroDivision = 'error'
+		self.inPorts['zerodivision'] = {
+			'datatype': 'string',
+			'values': self.zeroDivisionPolicies
+		}
+
+		zeroDivisionPort = self.inPorts['zerodivision']
+
+		@zeroDivisionPort.on('data')
+		def onData (data):
+			if data['data'] not in self.zeroDivisionPolicies:
+				return self.error(ValueError("Unknown zero division policy {!r}".format(data['data'])))
+
+			self.zeroDivision = data['data']
+
 	def calculate (self, a, b):
-		return float(a) / b
+		if numpy is not None and (isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray)):
+			return self.divideArrays(a, b)
+
+		if b != 0:
+			return float(a) / b
+
+		policy = self.zeroDivision
+
+		if policy == 'error':
+			raise ZeroDivisionError("Division by zero")
+
+		if policy == 'zero':
+			return 0.0
+
+		if policy == 'inf' and a != 0 and a == a:
+			return float('inf') if a > 0 else float('-inf')
+
+		return float('nan')
+
+	def divideArrays (self, a, b):
+		zeros = numpy.equal(b, 0)
+		policy = self.zeroDivision
+
+		if policy == 'error' and numpy.any(zeros):
+			raise ZeroDivisionError("Division by zero")
+
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			result = numpy.true_divide(a, b)
+
+		# true_divide already gives signed infinities, and NaN for 0 / 0
+		if policy == 'nan':
+			result = numpy.where(zeros, numpy.nan, result)
+		elif policy == 'zero':
+			result = numpy.where(zeros, 0.0, result)
 
-	
\ No newline at end of file
+		return result
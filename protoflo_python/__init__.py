@@ -2,6 +2,13 @@ from protoflo.component import Component
 from protoflo.helper import MapComponent
 from protoflo.port import InPorts, OutPorts
 
+import operator
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 name = "python"
 description = "Protoflo Python Components"
 
@@ -11,26 +18,73 @@ class CastComponent (Component):
 	]
 
 
+def _bulk (cast, castArray):
+	"""Extend the cast of a packet to lists and tuples, cast item by item
+	into a sequence of the same type, and NumPy arrays, cast by castArray
+	in one call."""
+
+	def convert (d):
+		kind = type(d)
+
+		if kind is list:
+			return map(cast, d)
+
+		if kind is tuple:
+			return tuple(map(cast, d))
+
+		if numpy is not None and isinstance(d, numpy.ndarray):
+			return castArray(d)
+
+		return cast(d)
+
+	return convert
+
+
+def _toBoolean (d):
+	if type(d) in (str, unicode) and d.lower() == "false":
+		return False
+
+	return bool(d)
+
+def _toBooleans (array):
+	if array.dtype.kind in 'SU':
+		return (numpy.char.lower(array) != "false") & (array != "")
+
+	return array.astype(bool)
+
+def _toStrings (array):
+	# NumPy formats floats with more digits than str() does on Python 2,
+	# so they are cast item by item like the items of lists are
+	if array.dtype.kind in 'fc':
+		return numpy.array(map(str, array.ravel().tolist())).reshape(array.shape)
+
+	return array.astype(str)
+
+
 def Str (metadata = None):
 	c = CastComponent(outPorts = [
-		('out', { "datatype": "string", "required": False })
+		('out', { "datatype": "all", "required": False })
 	])
 	
+	cast = _bulk(str, _toStrings)
+
 	def process (data, groups, outPort):
-		outPort.send(str(data['data']))
+		outPort.send(cast(data['data']))
 
-	return MapComponent(c, process)
+	return MapComponent(c, process, { "groups": False })
 
 
 def Int (metadata = None):
 	c = CastComponent(outPorts = [
-		('out', { "datatype": "int", "required": False })
+		('out', { "datatype": "all", "required": False })
 	])
 	
+	cast = _bulk(int, lambda array: array.astype(int))
+
 	def process (data, groups, outPort):
-		outPort.send(int(data['data']))
+		outPort.send(cast(data['data']))
 
-	return MapComponent(c, process)
+	return MapComponent(c, process, { "groups": False })
 
 
 def Float (metadata = None):
@@ -38,37 +92,38 @@ def Float (metadata = None):
 		('out', { "datatype": "number", "required": False })
 	])
 	
+	cast = _bulk(float, lambda array: array.astype(float))
+
 	def process (data, groups, outPort):
-		outPort.send(float(data['data']))
+		outPort.send(cast(data['data']))
 
-	return MapComponent(c, process)
+	return MapComponent(c, process, { "groups": False })
 
 
 def Boolean (metadata = None):
 	c = CastComponent(outPorts = [
-		('out', { "datatype": "boolean", "required": False })
+		('out', { "datatype": "all", "required": False })
 	])
 	
-	def process (data, groups, outPort):
-		d = data['data']
+	cast = _bulk(_toBoolean, _toBooleans)
 
-		if type(d) in (str, unicode) and d.lower() == "false":
-			outPort.send(False)
-		else:
-			outPort.send(bool(d))
+	def process (data, groups, outPort):
+		outPort.send(cast(data['data']))
 
-	return MapComponent(c, process)
+	return MapComponent(c, process, { "groups": False })
 
 
 def Invert (metadata = None):
 	c = CastComponent(outPorts = [
-		('out', { "datatype": "boolean", "required": False })
+		('out', { "datatype": "all", "required": False })
 	])
 
+	cast = _bulk(operator.not_, lambda array: numpy.logical_not(array))
+
 	def process (data, groups, outPort):
-		outPort.send(not data['data'])
+		outPort.send(cast(data['data']))
 
-	return MapComponent(c, process)
+	return MapComponent(c, process, { "groups": False })
 
 
 __components__ = {
@@ -0,0 +1,14 @@
+from . import window
+
+title = "ProtoFlo Statistics Components"
+name = "stats"
+description = "Aggregates over sliding windows"
+
+__components__ = {
+	'Sum': window.Sum,
+	'Mean': window.Mean,
+	'Variance': window.Variance,
+	'StandardDeviation': window.StandardDeviation,
+	'Min': window.Min,
+	'Max': window.Max
+}
@@ -0,0 +1,458 @@
+from protoflo.component import Component
+from protoflo.port import InPorts, OutPorts
+
+from bisect import bisect_left
+from itertools import repeat
+from timeit import default_timer
+import math
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Aggregates over a sliding window of the numbers arriving at a component.
+# A window holds the last [size] numbers, the numbers of the last [period]
+# seconds, or both; with neither, it holds every number since the last
+# reset. Groups opening or closing reset the window, so that aggregates
+# never span bracket boundaries.
+#
+# Every aggregate is updated in O(1) per number, adding the newest and
+# removing the oldest ones. A packet holding a sequence or an array of
+# numbers is added in one go, vectorised with NumPy when it is available,
+# and one aggregate is sent for the whole packet.
+
+
+def _toNumber (value):
+	if isinstance(value, basestring):
+		return float(value)
+
+	return value
+
+def _toBatch (value):
+	"""Cast a sequence packet to a NumPy array of numbers, or a list
+	without NumPy. Returns None for anything else."""
+
+	if numpy is not None:
+		if isinstance(value, (list, tuple)):
+			value = numpy.asarray(value)
+		elif not isinstance(value, numpy.ndarray):
+			return None
+
+		if value.dtype.kind not in 'biuf':
+			value = value.astype(float)
+
+		return value.ravel()
+
+	if isinstance(value, (list, tuple)):
+		return [_toNumber(v) for v in value]
+
+	return None
+
+def _asArray (values):
+	if numpy is not None and not isinstance(values, numpy.ndarray):
+		return numpy.asarray(values, dtype = float)
+
+	return values
+
+def _moments (values):
+	""" Mean and sum of squared differences from it of [values]. """
+
+	values = _asArray(values)
+
+	if numpy is not None:
+		mean = values.mean()
+		return mean, ((values - mean) ** 2).sum()
+
+	mean = float(sum(values)) / len(values)
+	return mean, sum((v - mean) ** 2 for v in values)
+
+
+class RunningSum (object):
+	def __init__ (self):
+		self.clear()
+
+	def clear (self):
+		self.total = 0
+
+	def push (self, x):
+		self.total += x
+
+	def pop (self, x):
+		self.total -= x
+
+	def extend (self, values):
+		self.total += _asArray(values).sum() if numpy is not None else sum(values)
+
+	def discard (self, values):
+		self.total -= _asArray(values).sum() if numpy is not None else sum(values)
+
+
+class Welford (object):
+	"""Running mean and variance (Welford). Batches are merged in and out
+	with the pairwise update of Chan et al.
+
+	@ivar m2: Sum of squared differences from the mean.
+	"""
+
+	def __init__ (self):
+		self.clear()
+
+	def clear (self):
+		self.n = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	@property
+	def variance (self):
+		return self.m2 / self.n if self.n else None
+
+	def push (self, x):
+		self.n += 1
+		d = x - self.mean
+		self.mean += d / self.n
+		self.m2 += d * (x - self.mean)
+
+	def pop (self, x):
+		if self.n <= 1:
+			return self.clear()
+
+		self.n -= 1
+		d = x - self.mean
+		self.mean -= d / self.n
+		self.m2 = max(self.m2 - d * (x - self.mean), 0.0)
+
+	def extend (self, values):
+		count = len(values)
+		if not count:
+			return
+
+		mean, m2 = _moments(values)
+		n = self.n + count
+		d = mean - self.mean
+
+		self.mean += d * count / n
+		self.m2 += m2 + d * d * self.n * count / n
+		self.n = n
+
+	def discard (self, values):
+		count = len(values)
+		if not count:
+			return
+
+		if count >= self.n:
+			return self.clear()
+
+		mean, m2 = _moments(values)
+		n = self.n - count
+		rest = (self.n * self.mean - count * mean) / n
+		d = mean - rest
+
+		self.m2 = max(self.m2 - m2 - d * d * n * count / self.n, 0.0)
+		self.mean = rest
+		self.n = n
+
+
+class Extreme (object):
+	"""Minimum or maximum of a queue with two stacks: numbers are pushed
+	on the back stack, which only keeps its overall extreme, and popped
+	from the front one, which keeps the extreme of every number below
+	each number. The front stack is refilled from the back one when
+	empty, so each number is moved once.
+
+	@param better: C{min} or C{max}.
+	"""
+
+	def __init__ (self, better):
+		self.better = better
+
+		if numpy is not None:
+			self.accumulate = (numpy.minimum if better is min else numpy.maximum).accumulate
+
+		self.clear()
+
+	def clear (self):
+		self.front = []
+		self.back = []
+		self.backExtreme = None
+
+	@property
+	def value (self):
+		if not len(self.front):
+			return self.backExtreme
+
+		if not len(self.back):
+			return self.front[-1]
+
+		return self.better(self.front[-1], self.backExtreme)
+
+	def push (self, x):
+		self.backExtreme = x if not len(self.back) else self.better(self.backExtreme, x)
+		self.back.append(x)
+
+	def pop (self, x = None):
+		if not len(self.front):
+			self._refill()
+
+		self.front.pop()
+
+	def extend (self, values):
+		if not len(values):
+			return
+
+		if numpy is not None:
+			values = _asArray(values)
+			extreme = values.min() if self.better is min else values.max()
+			values = values.tolist()
+		else:
+			extreme = self.better(values)
+
+		self.backExtreme = extreme if not len(self.back) else self.better(self.backExtreme, extreme)
+		self.back.extend(values)
+
+	def discard (self, values):
+		count = len(values)
+
+		while count:
+			if not len(self.front):
+				self._refill()
+
+			popped = min(count, len(self.front))
+			del self.front[len(self.front) - popped:]
+			count -= popped
+
+	def _refill (self):
+		# The oldest number ends up on top, with the extreme of them all
+		if numpy is not None:
+			self.front = self.accumulate(numpy.asarray(self.back[::-1])).tolist()
+		else:
+			better = self.better
+			extreme = None
+
+			for x in reversed(self.back):
+				extreme = x if extreme is None else better(extreme, x)
+				self.front.append(extreme)
+
+		self.back = []
+		self.backExtreme = None
+
+
+class Window (object):
+	"""The numbers of a sliding window, and an aggregate of them.
+
+	@type size: C{int}
+	@ivar size: Maximum number of numbers held, 0 for no limit.
+
+	@type period: C{float}
+	@ivar period: Seconds a number is held for, 0 for no limit.
+	"""
+
+	def __init__ (self, aggregate, size = 0, period = 0):
+		self.aggregate = aggregate
+		self.size = size
+		self.period = period
+		self.clear()
+
+	def clear (self):
+		# Removed numbers are skipped by moving the head, and only deleted
+		# once they are half of the list
+		self.values = []
+		self.times = []
+		self.head = 0
+		self.aggregate.clear()
+
+	def __len__ (self):
+		return len(self.values) - self.head
+
+	def add (self, x, now = None):
+		now = default_timer() if now is None else now
+
+		self.values.append(x)
+		self.times.append(now)
+		self.aggregate.push(x)
+		self.evict(now)
+
+	def extend (self, values, now = None):
+		now = default_timer() if now is None else now
+
+		# Only the newest numbers of a large batch would stay
+		if self.size and len(values) >= self.size:
+			self.clear()
+			values = values[len(values) - self.size:]
+
+		self.aggregate.extend(values)
+
+		if numpy is not None and isinstance(values, numpy.ndarray):
+			values = values.tolist()
+
+		self.values.extend(values)
+		self.times.extend(repeat(now, len(values)))
+		self.evict(now)
+
+	def evict (self, now):
+		head = self.head
+		count = 0
+
+		if self.size:
+			count = len(self.values) - head - self.size
+
+		if self.period:
+			count = max(count, bisect_left(self.times, now - self.period, head) - head)
+
+		if count <= 0:
+			return
+
+		if count == 1:
+			self.aggregate.pop(self.values[head])
+		else:
+			self.aggregate.discard(self.values[head:head + count])
+
+		self.head = head = head + count
+
+		if head > 1024 and head * 2 > len(self.values):
+			del self.values[:head]
+			del self.times[:head]
+			self.head = 0
+
+
+class _WindowComponent (Component):
+	def initialize (self):
+		self.inPorts = InPorts()
+		self.inPorts["in"] = {
+			"datatype": "number",
+			"description": "Numbers to aggregate, one at a time or in a sequence"
+		}
+		self.inPorts["size"] = {
+			"datatype": "int",
+			"description": "Number of numbers in the window, 0 for no limit"
+		}
+		self.inPorts["period"] = {
+			"datatype": "number",
+			"description": "Seconds of numbers in the window, 0 for no limit"
+		}
+		self.inPorts["reset"] = { "datatype": "bang" }
+
+		self.outPorts = OutPorts()
+		self.outPorts["out"] = { "datatype": "number" }
+
+		inPort = self.inPorts["in"]
+		sizePort = self.inPorts["size"]
+		periodPort = self.inPorts["period"]
+		resetPort = self.inPorts["reset"]
+		outPort = self.outPorts["out"]
+
+		self.window = Window(self.createAggregate())
+
+		@inPort.on('begingroup')
+		def onBeginGroup (data):
+			self.window.clear()
+			outPort.beginGroup(data['group'])
+
+		@inPort.on('data')
+		def onData (data):
+			batch = _toBatch(data['data'])
+
+			try:
+				if batch is None:
+					self.window.add(_toNumber(data['data']))
+				else:
+					self.window.extend(batch)
+			except (TypeError, ValueError):
+				self.window.clear()
+				return self.error(TypeError("Must pass numbers to aggregating components"))
+
+			if not len(self.window):
+				return
+
+			result = self.result(self.window.aggregate)
+
+			if numpy is not None and isinstance(result, numpy.generic):
+				result = result.item()
+
+			if outPort.attached:
+				outPort.send(result)
+
+		@inPort.on('endgroup')
+		def onEndGroup (data):
+			self.window.clear()
+			outPort.endGroup()
+
+		@inPort.on('disconnect')
+		def onDisconnect (data):
+			outPort.disconnect()
+
+		@sizePort.on('data')
+		def onSize (data):
+			self.window.size = max(int(data['data'] or 0), 0)
+
+		@periodPort.on('data')
+		def onPeriod (data):
+			self.window.period = max(float(data['data'] or 0), 0.0)
+
+		@resetPort.on('data')
+		def onReset (data):
+			self.window.clear()
+
+	def createAggregate (self):
+		raise NotImplementedError
+
+	def result (self, aggregate):
+		raise NotImplementedError
+
+
+class Sum (_WindowComponent):
+	icon = 'plus'
+
+	def createAggregate (self):
+		return RunningSum()
+
+	def result (self, aggregate):
+		return aggregate.total
+
+
+class Mean (_WindowComponent):
+	def createAggregate (self):
+		return Welford()
+
+	def result (self, aggregate):
+		return aggregate.mean
+
+
+class Variance (_WindowComponent):
+	"""Population variance of the window."""
+
+	def createAggregate (self):
+		return Welford()
+
+	def result (self, aggregate):
+		return aggregate.variance
+
+
+class StandardDeviation (_WindowComponent):
+	"""Population standard deviation of the window."""
+
+	def createAggregate (self):
+		return Welford()
+
+	def result (self, aggregate):
+		return math.sqrt(aggregate.variance)
+
+
+class Min (_WindowComponent):
+	icon = 'arrow-down'
+
+	def createAggregate (self):
+		return Extreme(min)
+
+	def result (self, aggregate):
+		return aggregate.value
+
+
+class Max (_WindowComponent):
+	icon = 'arrow-up'
+
+	def createAggregate (self):
+		return Extreme(max)
+
+	def result (self, aggregate):
+		return aggregate.value